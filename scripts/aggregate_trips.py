@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import storage
+from pair_keys import add_pair_key
+from od_tensor import ODTensor
+from instrumentation import measure
+from time_bins import time_bins
+from create_station_pairs import MAX_STATION_ID, add_station_coordinates
+from create_net_flows import create_net_flow_df
+
+'''
+Single pass over the trip partitions that produces all three aggregate tables:
+station_pair_counts, grouped_counts and net_flows, plus the OD-by-hour tensor the visuals query.
+
+Every batch of trips is reduced to a partial aggregate of (departure, return, hour) counts.
+Partials are mergeable, so they are folded together whenever the pending ones grow past
+the memory budget. Memory depends on the budget and the number of distinct keys, not on
+the number of trips, so multi-year inputs stream through the same way as one year.
+The pair counts and net flows are both marginals of the hourly counts.
+'''
+
+MEMORY_BUDGET_MB = 512
+
+# working set per trip while a batch is reduced: timestamp, ids, hour, packed key and the sort copy
+BYTES_PER_TRIP = 64
+# a partial aggregate keeps a packed key and a count per row
+BYTES_PER_KEY = 16
+
+TRIP_COLUMNS = ["Departure station id", "Return station id"]
+
+
+def pack_keys(dep_ids, ret_ids, hours):
+    return (dep_ids.astype(np.int64) << 24) | (ret_ids.astype(np.int64) << 8) | hours
+
+def unpack_keys(keys):
+    return keys >> 24, (keys >> 8) & 0xFFFF, keys & 0xFF
+
+
+class HourlyCounts():
+    '''
+    Mergeable partial aggregate: sorted unique packed (dep, ret, hour) keys and their counts.
+    '''
+    def __init__(self, keys=None, counts=None):
+        self.keys = np.empty(0, dtype=np.int64) if keys is None else keys
+        self.counts = np.empty(0, dtype=np.int64) if counts is None else counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_trips(cls, dep_ids, ret_ids, hours):
+        keys = pack_keys(dep_ids, ret_ids, hours)
+        keys, counts = np.unique(keys, return_counts=True)
+        return cls(keys, counts.astype(np.int64))
+
+    @classmethod
+    def from_frame(cls, grouped_counts_df):
+        keys = pack_keys(grouped_counts_df["Departure station id"].to_numpy(), grouped_counts_df["Return station id"].to_numpy(), grouped_counts_df["hour"].to_numpy().astype(np.int64))
+        order = np.argsort(keys)
+        return cls(keys[order], grouped_counts_df["count"].to_numpy().astype(np.int64)[order])
+
+    @classmethod
+    def merge(cls, partials):
+        partials = [partial for partial in partials if len(partial)]
+        if not partials:
+            return cls()
+        if len(partials) == 1:
+            return partials[0]
+
+        keys, inverse = np.unique(np.concatenate([partial.keys for partial in partials]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([partial.counts for partial in partials]), minlength=len(keys))
+        return cls(keys, counts.astype(np.int64))
+
+    def to_frame(self):
+        dep_ids, ret_ids, hours = unpack_keys(self.keys)
+        df = pd.DataFrame({
+            "Departure station id": dep_ids,
+            "Return station id": ret_ids,
+            "hour": hours,
+            "count": self.counts,
+        })
+        return add_pair_key(df)
+
+
+def batch_rows(memory_budget_mb):
+    # half of the budget for the batch being reduced, half for the pending partials
+    return max(10_000, memory_budget_mb * 1_000_000 // 2 // BYTES_PER_TRIP)
+
+def iter_trip_batches(partition_paths, rows, bins=("hour",)):
+    '''
+    Departure and return station ids and a dict of the time bins of every batch of trips. The bins
+    are read from the partitions, partitions written before they had bins get them computed.
+    '''
+    for path in partition_paths:
+        parquet_file = pq.ParquetFile(path)
+        stored = all(name in parquet_file.schema_arrow.names for name in bins)
+        columns = TRIP_COLUMNS + (list(bins) if stored else ["Departure"])
+        for batch in parquet_file.iter_batches(batch_size=rows, columns=columns):
+            if stored:
+                codes = {name: batch.column(name).to_numpy() for name in bins}
+            else:
+                codes = time_bins(batch.column("Departure").cast("timestamp[ms]").cast("int64").to_numpy(), bins)
+            yield batch.column("Departure station id").to_numpy(), batch.column("Return station id").to_numpy(), codes
+
+def aggregate_partitions(partition_paths, memory_budget_mb=MEMORY_BUDGET_MB):
+    rows = batch_rows(memory_budget_mb)
+    merge_threshold = memory_budget_mb * 1_000_000 // 2 // BYTES_PER_KEY
+
+    total = HourlyCounts()
+    pending = []
+    pending_keys = 0
+
+    with measure("aggregate_partitions", partitions=len(partition_paths)) as record:
+        trips = 0
+        for dep_ids, ret_ids, bins in iter_trip_batches(partition_paths, rows):
+            partial = HourlyCounts.from_trips(dep_ids, ret_ids, bins["hour"])
+            pending.append(partial)
+            pending_keys += len(partial)
+            trips += len(dep_ids)
+
+            if pending_keys > merge_threshold:
+                total = HourlyCounts.merge([total] + pending)
+                pending = []
+                pending_keys = 0
+
+        total = HourlyCounts.merge([total] + pending)
+        record["rows_in"] = trips
+        record["rows_out"] = len(total)
+
+    return total
+
+
+def create_station_pair_counts(grouped_counts_df, stations_df):
+    df = grouped_counts_df[(grouped_counts_df["Departure station id"] < MAX_STATION_ID) & (grouped_counts_df["Return station id"] < MAX_STATION_ID)]
+    df = df.groupby(["Departure station id", "Return station id"])["count"].sum().reset_index()
+    return add_station_coordinates(df, stations_df)
+
+def create_net_flows(grouped_counts_df, stations_df):
+    return create_net_flow_df(grouped_counts_df, stations_df)
+
+def write_products(hourly_counts, stations_path):
+    with measure("write_products", rows_in=len(hourly_counts)):
+        grouped_counts_df = hourly_counts.to_frame()
+        storage.write_table(grouped_counts_df, "grouped_counts")
+        ODTensor.from_grouped_counts(grouped_counts_df).save()
+
+        stations_df = pd.read_csv(stations_path)
+        storage.write_table(create_station_pair_counts(grouped_counts_df, stations_df), "station_pair_counts")
+        storage.write_table(create_net_flows(grouped_counts_df, stations_df), "net_flows")
+
+
+def aggregate_trips_main(memory_budget_mb=MEMORY_BUDGET_MB):
+    cwd = os.getcwd()
+    stations_path = f"{cwd}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
+
+    partition_paths = storage.trip_partitions()
+    hourly_counts = aggregate_partitions(partition_paths, memory_budget_mb)
+    write_products(hourly_counts, stations_path)
+
+    # a full rebuild covers exactly the partitions on disk
+    manifest = storage.read_manifest()
+    manifest["partitions"] = {os.path.basename(path)[:-len(".parquet")]: storage.partition_rows(path) for path in partition_paths}
+    manifest["pending"] = {}
+    storage.write_manifest(manifest)
+
+if __name__ == "__main__":
+    aggregate_trips_main()
@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyogrio.raw
+
+import storage
+from instrumentation import measure
+from fetch import ensure_resource
+
+'''
+Small statistical areas of Espoo and Helsinki for the segmented map, built once.
+The Espoo areas come from the Espoo WFS through the fetch layer.
+
+The areas are projected to EPSG:3387, clipped against the sea and saved as GeoParquet
+(areas.parquet) together with the unclipped areas, which the stations are matched against.
+An STRtree can not be saved as such, pickling one only keeps its geometries, so the tree over
+the unclipped areas is built when the layer is loaded, its positions are the rows of
+areas.parquet. The layer directory is written aside and swapped in whole. Segmenting the
+areas by the station clusters is then an STRtree query of the stations, a bincount weighted
+vote per area and a union of the clipped areas per group, with no reading, reprojecting or
+overlaying of the sources.
+'''
+
+CRS = "EPSG:3387"
+
+# areas left out of the segmentation, positions in the concatenated Espoo and Helsinki areas
+AREAS_TO_DROP = [176, 340, 388, 339, 211, 387, 177, 166, 362, 286, 148, 230]
+
+# Espoo area kept even without stations
+ESPOO_KEPT_AREA = 311
+
+# WKB geometry types, the Espoo GML has polyhedral surfaces that shapely does not read
+WKB_POLYHEDRAL_SURFACE = 15
+WKB_MULTIPOLYGON = 6
+
+
+def read_gml_areas(gml_path):
+    '''
+    The GML features with the polyhedral surfaces read as multipolygons, their WKB layout is the same.
+    '''
+    meta, _, wkb, fields = pyogrio.raw.read(gml_path)
+    geometries = []
+    for geometry in wkb:
+        byteorder = "little" if geometry[0] == 1 else "big"
+        if int.from_bytes(geometry[1:5], byteorder) == WKB_POLYHEDRAL_SURFACE:
+            geometry = geometry[:1] + WKB_MULTIPOLYGON.to_bytes(4, byteorder) + geometry[5:]
+        geometries.append(geometry)
+    df = pd.DataFrame(dict(zip(meta["fields"], fields)))
+    return gpd.GeoDataFrame(df, geometry=shapely.from_wkb(geometries), crs=meta["crs"])
+
+
+def default_dir():
+    return f"{storage.processed_dir()}/areas"
+
+
+class AreaLayer():
+    def __init__(self, areas_gdf, tree):
+        self.areas_gdf = areas_gdf
+        self.tree = tree
+
+    @classmethod
+    def build(cls, espoo_gml_path, helsinki_areas_path, sea_paths):
+        espoo_areas = read_gml_areas(espoo_gml_path)
+        espoo_areas = espoo_areas[espoo_areas["tyyppi"]=="pienalue"][["tunnus","geometry"]].rename(columns={"tunnus":"id_espoo"})
+        helsinki_areas = gpd.read_file(helsinki_areas_path)[["geometry"]]
+
+        areas_gdf = pd.concat([espoo_areas.to_crs(CRS), helsinki_areas.to_crs(CRS)]).reset_index(drop=True)
+        areas_gdf["area_id"] = areas_gdf.index
+        areas_gdf = areas_gdf[~areas_gdf["area_id"].isin(AREAS_TO_DROP)].reset_index(drop=True)
+        areas_gdf["geometry"] = shapely.make_valid(areas_gdf.geometry.to_numpy())
+
+        # only the sea class of the first sea shapefile
+        sea = [gpd.read_file(path) for path in sea_paths]
+        sea[0] = sea[0][sea[0]["Kohdeluokk"]==36211]
+        sea = shapely.union_all(shapely.make_valid(pd.concat([gdf.to_crs(CRS) for gdf in sea]).geometry.to_numpy()))
+
+        tree = shapely.STRtree(areas_gdf.geometry.to_numpy())
+        with measure("sea_clip", rows_in=len(areas_gdf)):
+            areas_gdf["geometry"] = areas_gdf.geometry.difference(sea)
+        return cls(areas_gdf[["area_id", "id_espoo", "geometry"]], tree)
+
+    @classmethod
+    def load(cls, save_dir=None):
+        save_dir = save_dir or default_dir()
+        areas_gdf = gpd.read_parquet(f"{save_dir}/areas.parquet")
+        tree = shapely.STRtree(areas_gdf["unclipped"].to_numpy())
+        return cls(areas_gdf.drop(columns="unclipped"), tree)
+
+    def save(self, save_dir=None):
+        save_dir = save_dir or default_dir()
+        areas_gdf = self.areas_gdf.copy()
+        areas_gdf["unclipped"] = gpd.GeoSeries(self.tree.geometries, index=areas_gdf.index, crs=CRS)
+        with storage.replace_dir(save_dir) as tmp_dir:
+            areas_gdf.to_parquet(f"{tmp_dir}/areas.parquet")
+
+    def station_areas(self, points):
+        '''
+        (station position, area position) pairs of the points in the areas, a point on a border is in both.
+        '''
+        return self.tree.query(points, predicate="intersects")
+
+    def area_groups(self, points, groups, volumes):
+        '''
+        Group of every area: the volume weighted mean group of its stations, rounded. Espoo areas
+        without stations (or without volume) are left out as NaN, the other empty areas get the
+        group of their nearest station.
+        '''
+        n = len(self.areas_gdf)
+        volumes = np.nan_to_num(volumes)
+        station, area = self.station_areas(points)
+
+        volume_sums = np.bincount(area, weights=volumes[station], minlength=n)
+        with np.errstate(invalid="ignore"):
+            area_groups = np.round(np.bincount(area, weights=groups[station] * volumes[station], minlength=n) / volume_sums)
+
+        espoo = self.areas_gdf["id_espoo"].notna().to_numpy() & (self.areas_gdf["id_espoo"] != ESPOO_KEPT_AREA).to_numpy()
+        empty = np.flatnonzero(np.isnan(area_groups) & ~espoo)
+        if len(empty):
+            nearest, station = shapely.STRtree(points).query_nearest(self.tree.geometries[empty], all_matches=True)
+            group_ids = groups[station].astype(np.int64)
+            votes = np.zeros((len(empty), group_ids.max() + 1), dtype=np.int64)
+            np.add.at(votes, (nearest, group_ids), 1)
+            # stations at the same distance vote, ties go to the smaller group
+            area_groups[empty] = votes.argmax(axis=1)
+        return area_groups
+
+    def segment(self, points_gdf, volumes):
+        '''
+        The clipped areas dissolved by group, for points_gdf stations with group column and their volumes.
+        '''
+        points = points_gdf.to_crs(CRS).geometry.to_numpy()
+        area_groups = self.area_groups(points, points_gdf["group"].to_numpy(dtype=np.float64), np.asarray(volumes, dtype=np.float64))
+
+        kept = ~np.isnan(area_groups)
+        segments = pd.Series(self.areas_gdf.geometry.to_numpy()[kept]).groupby(area_groups[kept]).agg(shapely.union_all)
+        return gpd.GeoDataFrame({"group": segments.index.to_numpy()}, geometry=segments.to_numpy(), crs=CRS)
+
+
+def area_layer_main():
+    cwd = os.getcwd()
+    espoo_gml_path = ensure_resource("espoo_areas")
+    helsinki_areas_path = f"{cwd}/data/raw/pienalueet_WFS.gpkg"
+    sea_paths = [f"{cwd}/data/raw/meri/L41_VesiAlue.shp", f"{cwd}/data/raw/meri/K42_VesiAlue.shp"]
+
+    AreaLayer.build(espoo_gml_path, helsinki_areas_path, sea_paths).save()
+
+if __name__ == "__main__":
+    area_layer_main()
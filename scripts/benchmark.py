@@ -0,0 +1,138 @@
+import os
+import json
+import shutil
+import argparse
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from synthetic import SCALES, write_synthetic_partitions, build_synthetic_graph_store
+from instrumentation import run_stage
+
+'''
+Runs the pipeline stages on synthetic data at several scales and records their throughput
+and peak memory.
+
+Every scale gets its own workspace (benchmarks/workspaces/<scale>) with a copy of data/raw,
+synthetic trip partitions and the synthetic road graph, so nothing is downloaded and the
+real data/processed is not touched. Each stage runs in a fresh process, so its peak memory
+is its own. Results are appended to benchmarks/results.jsonl with the commit they were
+measured on, benchmark_history lines them up over time.
+'''
+
+STATIONS_FILE = "Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
+
+# the download is replaced by the synthetic trips
+SKIPPED_STAGES = ["download_trip_data"]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_workspace(raw_dir, workspace, trips, seed=0):
+    '''
+    Copies the raw data and writes the synthetic trips and graph, unless the workspace already holds the same trips.
+    '''
+    shutil.copytree(raw_dir, f"{workspace}/data/raw", dirs_exist_ok=True)
+    os.makedirs(f"{workspace}/presentation", exist_ok=True)
+    stations_path = f"{workspace}/data/raw/{STATIONS_FILE}"
+    meta_path = f"{workspace}/synthetic.json"
+    meta = {"trips": trips, "seed": seed}
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                return
+
+    shutil.rmtree(f"{workspace}/data/processed", ignore_errors=True)
+    write_synthetic_partitions(stations_path, f"{workspace}/data/processed/trips", trips, seed=seed)
+    build_synthetic_graph_store(stations_path, f"{workspace}/data/processed/graph", seed=seed)
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
+def run_stage_in_workspace(workspace, stage_name):
+    # runs in a fresh process, the stages read and write relative to the working directory
+    from pipeline import STAGES
+
+    os.chdir(workspace)
+    stage = {stage.name: stage for stage in STAGES}[stage_name]
+    return run_stage(stage.name, stage.func, stage.config)
+
+def benchmark_stage(workspace, stage_name):
+    with ProcessPoolExecutor(1) as executor:
+        return executor.submit(run_stage_in_workspace, workspace, stage_name).result()
+
+
+def benchmark_scale(raw_dir, workspace_root, scale, stages):
+    trips = SCALES[scale]
+    workspace = os.path.abspath(f"{workspace_root}/{scale}")
+    prepare_workspace(raw_dir, workspace, trips)
+
+    rows = []
+    for stage_name in stages:
+        row = {"scale": scale, "trips": trips, "stage": stage_name}
+        try:
+            record = benchmark_stage(workspace, stage_name)
+        except Exception as e:
+            # e.g. a stage that still needs the network, the other stages are measured anyway
+            row["error"] = f"{type(e).__name__}: {e}"
+            print(f"{scale} {stage_name}: {row['error']}")
+        else:
+            row.update({
+                "wall_seconds": record["wall_seconds"],
+                "cpu_seconds": record["cpu_seconds"],
+                "peak_rss_mb": record["peak_rss_mb"],
+                "children_peak_rss_mb": record["children_peak_rss_mb"],
+                "trips_per_second": trips / record["wall_seconds"],
+                "steps": record["steps"],
+            })
+            print(f"{scale} {stage_name}: {record['wall_seconds']:.1f} s, {record['peak_rss_mb']:.0f} MB")
+        rows.append(row)
+    return rows
+
+
+def append_results(rows, results_path):
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    run = {"measured_at": datetime.now().isoformat(timespec="seconds"), "commit": git_commit(), "cpu_count": os.cpu_count()}
+    with open(results_path, "a") as f:
+        for row in rows:
+            f.write(json.dumps({**run, **row}) + "\n")
+
+def benchmark_history(results_path):
+    '''
+    Wall time and peak memory of every stage and scale per benchmark run, oldest first.
+    '''
+    df = pd.read_json(results_path, lines=True)
+    if "error" in df:
+        df = df[df["error"].isna()]
+    df["commit"] = df["commit"].fillna("")
+    return df.pivot_table(index=["scale", "stage"], columns=["measured_at", "commit"], values=["wall_seconds", "peak_rss_mb"])
+
+
+def benchmark_main(scales=("1M",), stages=None):
+    from pipeline import STAGES
+
+    cwd = os.getcwd()
+    raw_dir = f"{cwd}/data/raw"
+    workspace_root = f"{cwd}/benchmarks/workspaces"
+    results_path = f"{cwd}/benchmarks/results.jsonl"
+
+    stages = stages or [stage.name for stage in STAGES if stage.name not in SKIPPED_STAGES]
+    for scale in scales:
+        rows = benchmark_scale(raw_dir, workspace_root, scale, stages)
+        append_results(rows, results_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline stages on synthetic trips.")
+    parser.add_argument("--scale", action="append", choices=list(SCALES), help="can be repeated, 1M by default")
+    parser.add_argument("--stage", action="append", help="can be repeated, all stages after the download by default")
+    args = parser.parse_args()
+
+    benchmark_main(args.scale or ["1M"], args.stage)
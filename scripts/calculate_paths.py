@@ -1,26 +1,45 @@
-import pandas as pd
-import geopandas as gpd
 import osmnx as ox
-import pickle
 import os
-import logging
-from shapely.geometry import Point, LineString
+import time
 import multiprocessing
 
+import storage
+from pair_keys import add_pair_key
+from routing_pool import SharedGraph, route_pairs, route_pairs_by_origin, worker_report, benchmark_origin_grouping
+from route_cache import RouteCache
+from graph_store import GraphStore, build_graph_store
+from route_store import RouteStore, save_route_store
+from edge_incidence import build_edge_incidence
+from instrumentation import measure, record_workers
+
 '''
-Takes in the station_pair_counts.csv dataframe and returns a dataframe with the paths between each station pair.
+Takes in the station_pair_counts table and saves the path between each undirected station pair
+as node sequences in the route store (data/processed/routes).
 '''
 
 class DataProcessor():
-    def __init__(self, grouper_size):
+    def __init__(self, grouper_size, routing_mode="origin", route_cache_path=None):
         self.grouper = grouper_size
+        self.routing_mode = routing_mode
+        self.route_cache_path = route_cache_path
+        self.G = None
     
-    def load_data(self, path):
-        self.station_pair_counts = pd.read_csv(path)
+    def load_data(self, top_pairs=None):
+        self.station_pair_counts = storage.read_table("station_pair_counts")
 
         # duplicate paths removed
-        self.station_pair_counts["ids"] = self.station_pair_counts.apply(lambda row: tuple(sorted((int(row["Departure station id"]), int(row["Return station id"])))), axis=1)
-        self.station_pair_counts_dd = self.station_pair_counts.drop_duplicates("ids")
+        self.station_pair_counts = add_pair_key(self.station_pair_counts)
+        if top_pairs is not None:
+            # only the undirected pairs with the most trips, e.g. for a preview
+            top_keys = self.station_pair_counts.groupby("pair_key")["count"].sum().nlargest(top_pairs).index
+            self.station_pair_counts = self.station_pair_counts[self.station_pair_counts["pair_key"].isin(top_keys)]
+        self.station_pair_counts_dd = self.station_pair_counts.drop_duplicates("pair_key")
+
+    def drop_routed_pairs(self, route_store):
+        # pairs that already have a route in the store are not routed again
+        routed = route_store.pair_keys
+        self.station_pair_counts = self.station_pair_counts[~self.station_pair_counts["pair_key"].isin(routed)]
+        self.station_pair_counts_dd = self.station_pair_counts_dd[~self.station_pair_counts_dd["pair_key"].isin(routed)]
 
     def save_point_coordinates_to_lists(self):
         self.dep_points_x_list = self.station_pair_counts_dd["x_dep"].tolist()
@@ -37,63 +56,143 @@ class DataProcessor():
         top = max(self.dep_points_y_list)
         self.bbox = (left, bottom, right, top)
 
-    def create_graph(self, path):
-        G = ox.graph_from_bbox(self.bbox, network_type='bike')
-        with open(path, "wb") as f:
-            pickle.dump(G, f)
-        del G
+    def create_graph(self, store_dir, osm_path):
+        build_graph_store(store_dir, osm_path=osm_path, bbox=self.bbox)
     
-    def load_graph(self, path):
-        with open(path, "rb") as f:
-            self.G = pickle.load(f)
+    def load_graph(self, store_dir):
+        self.store = GraphStore(store_dir)
+
+    def networkx_graph(self):
+        # only the osmnx routing mode needs the full NetworkX graph
+        if self.G is None:
+            self.G = self.store.to_networkx()
+        return self.G
 
     def router(self, i, G, orig, dest):
-        print(f"Starting process {i}")
+        started = time.perf_counter()
         routes = ox.shortest_path(G, orig[i:i+self.grouper], dest[i:i+self.grouper])
-        print(f"Finish process {i}")
-        return routes
+        timing = {"pid": os.getpid(), "start": i, "pairs": len(routes), "seconds": time.perf_counter() - started}
+        return routes, timing
 
-    def calculate_routes(self):
-        orig = ox.nearest_nodes(self.G, self.dep_points_x_list, self.dep_points_y_list)
-        dest = ox.nearest_nodes(self.G, self.ret_points_x_list, self.ret_points_y_list)
-        args = [(i, self.G, orig, dest) for i in range(0, len(orig), self.grouper)]
+    def route_with_osmnx(self, orig, dest):
+        args = [(i, self.networkx_graph(), orig, dest) for i in range(0, len(orig), self.grouper)]
 
-        with multiprocessing.Pool(multiprocessing.cpu_count()-2) as pool:
-            results = pool.starmap(self.router, args)
+        with measure("routing", rows_in=len(orig), routing_mode="osmnx"):
+            with multiprocessing.Pool(max(1, multiprocessing.cpu_count()-2)) as pool:
+                results = pool.starmap(self.router, args)
+        record_workers("routing_workers", [timing for _, timing in results])
 
         # routes = [value for d in results for value in d.values()]
-        routes = [x for xs in results for x in xs]
-        route_coords = [[(self.G.nodes[node]["x"], self.G.nodes[node]["y"]) for node in route] for route in routes]
-        linestrings = [LineString(coords) if len(coords) > 1 else Point(coords) for coords in route_coords]
+        return [x for xs, _ in results for x in xs]
+
+    def route_with_shared_pool(self, orig, dest):
+        # the graph goes to the workers once through shared memory, tasks carry only node indices
+        node_ids = self.store.node_ids
+        engine = route_pairs_by_origin if self.routing_mode == "origin" else route_pairs
+        kwargs = {} if self.routing_mode == "origin" else {"chunk_size": self.grouper}
+
+        with measure("routing", rows_in=len(orig), routing_mode=self.routing_mode):
+            with SharedGraph(self.store.arrays()) as shared_graph:
+                routes, timings = engine(shared_graph, self.store.node_index(orig), self.store.node_index(dest), max(1, multiprocessing.cpu_count()-2), **kwargs)
+        record_workers("routing_workers", timings)
+        print(worker_report(timings).to_string(index=False))
 
-        # duplicate paths are mapped back to the main df
-        self.station_pair_counts_dd["geometry"] = linestrings
-        linedict = self.station_pair_counts_dd.set_index("ids")["geometry"].to_dict()
+        return [node_ids[route].tolist() if route is not None else None for route in routes]
 
-        self.journey_routes_df = gpd.GeoDataFrame(self.station_pair_counts)
-        self.journey_routes_df["geometry"] = self.journey_routes_df["ids"].map(linedict)
-        self.journey_routes_df = self.journey_routes_df.set_geometry("geometry")
-        self.journey_routes_df = self.journey_routes_df.set_crs("EPSG:4326")
+    def route(self, orig, dest):
+        if self.routing_mode == "osmnx":
+            return self.route_with_osmnx(orig, dest)
+        return self.route_with_shared_pool(orig, dest)
 
-    def save_gdf(self, path):
-        self.journey_routes_df.to_file(path)
+    def route_with_cache(self, orig, dest):
+        # only pairs the cache has not seen on this graph are routed
+        with RouteCache(self.route_cache_path, self.store.fingerprint) as cache:
+            found = cache.get_many(orig, dest)
+            missing = sorted(set(zip(map(int, orig), map(int, dest))) - found.keys())
 
-def calculate_paths_main(create_new_graph=True):
+            if missing:
+                missing_orig, missing_dest = [o for o, _ in missing], [d for _, d in missing]
+                new_routes = self.route(missing_orig, missing_dest)
+                cache.put_many(missing_orig, missing_dest, new_routes)
+                found.update(zip(missing, new_routes))
+
+            cache.evict()
+            print(cache.stats())
+
+        return [found[(int(o), int(d))] for o, d in zip(orig, dest)]
+
+    def calculate_routes(self):
+        orig = self.store.nearest_nodes(self.dep_points_x_list, self.dep_points_y_list)
+        dest = self.store.nearest_nodes(self.ret_points_x_list, self.ret_points_y_list)
+
+        if self.route_cache_path:
+            routes = self.route_with_cache(orig, dest)
+        else:
+            routes = self.route(orig, dest)
+
+        # unreachable pairs get a single node, like pairs with the same nearest node
+        routes = [route if route is not None else [o] for route, o in zip(routes, orig)]
+
+        # one route per undirected pair, stored as node indices of the graph store
+        self.pair_keys = self.station_pair_counts_dd["pair_key"].to_numpy()
+        self.routes = [self.store.node_index(route) for route in routes]
+
+    def save_routes(self, path, append=False):
+        if append:
+            RouteStore(path).append(self.pair_keys, self.routes)
+        else:
+            save_route_store(path, self.pair_keys, self.routes, self.store.fingerprint)
+
+def calculate_paths_main(create_new_graph=False, new_pairs_only=False, routing_mode="origin", top_pairs=None):
+    '''
+    The graph store is built when it is missing or create_new_graph is set, from data/raw/helsinki.osm if it exists.
+    With new_pairs_only the existing route store is kept and only pairs missing from it are routed and added,
+    as long as it was computed on the same graph. With top_pairs only that many pairs with the most trips are routed.
+    Returns the number of routed pairs.
+    '''
     cwd = os.getcwd()
-    station_pair_data_path = f"{cwd}/data/processed/station_pair_counts.csv"
-    graph_path = f"{cwd}/data/processed/graph.pkl"
-    save_path = f"{cwd}/data/processed/journey_routes.gpkg"
+    graph_path = f"{cwd}/data/processed/graph"
+    osm_path = f"{cwd}/data/raw/helsinki.osm"
+    save_path = f"{cwd}/data/processed/routes"
+    incidence_path = f"{cwd}/data/processed/edge_incidence"
+    route_cache_path = f"{cwd}/data/processed/route_cache.sqlite"
 
-    processor = DataProcessor(grouper_size=4000)
+    processor = DataProcessor(grouper_size=4000, routing_mode=routing_mode, route_cache_path=route_cache_path)
 
-    processor.load_data(station_pair_data_path)
+    processor.load_data(top_pairs)
     processor.save_point_coordinates_to_lists()
     processor.calculate_bbox()
-    if create_new_graph:
-        processor.create_graph(graph_path)
+    if create_new_graph or not GraphStore.exists(graph_path):
+        processor.create_graph(graph_path, osm_path)
     processor.load_graph(graph_path)
+
+    append = new_pairs_only and RouteStore.exists(save_path) and RouteStore(save_path).graph_fingerprint == processor.store.fingerprint
+    if append:
+        processor.drop_routed_pairs(RouteStore(save_path))
+        processor.save_point_coordinates_to_lists()
+        if not processor.dep_points_x_list:
+            return 0
     processor.calculate_routes()
-    processor.save_gdf(save_path)
+    processor.save_routes(save_path, append=append)
+    build_edge_incidence(RouteStore(save_path), incidence_path)
+    return len(processor.station_pair_counts_dd)
+
+def benchmark_routing_main():
+    '''
+    Per-pair against origin-grouped routing on the full station pair set.
+    '''
+    cwd = os.getcwd()
+    graph_path = f"{cwd}/data/processed/graph"
+
+    processor = DataProcessor(grouper_size=4000)
+    processor.load_data()
+    processor.save_point_coordinates_to_lists()
+    processor.load_graph(graph_path)
+
+    store = processor.store
+    orig = store.nearest_node_index(processor.dep_points_x_list, processor.dep_points_y_list)
+    dest = store.nearest_node_index(processor.ret_points_x_list, processor.ret_points_y_list)
+    return benchmark_origin_grouping(store.arrays(), orig, dest, max(1, multiprocessing.cpu_count()-2), processor.grouper)
 
 if __name__ == "__main__":
     calculate_paths_main()
\ No newline at end of file
@@ -1,44 +1,163 @@
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point
 
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+
+import storage
+from station_days import StationDays
+from create_net_flows import signed_log2
+from instrumentation import measure
 
 '''
 Take the net flow dataframe and segment the stations into two using K-Means clustering.
 Saves a dataframe with columns:
 Departure station id, group, coords
+
+The profile mode clusters the 24-hour net flow profiles of every station and day, or of every
+station and weekday, built from the station-day aggregates as a dense float32 matrix. It uses
+mini-batch k-means. Without a fixed k, every k in ks is fitted in parallel processes and the
+one with the best silhouette (on a sample) is kept. When the previous run of the mode had the
+same k, its labels give the initial centroids, so the fit starts close and the group numbers
+stay the same between runs.
 '''
 
+PROFILE_MODES = ("day", "weekday")
+DEFAULT_KS = range(2, 9)
+BATCH_SIZE = 4096
+SILHOUETTE_SAMPLE = 5_000
+
 def create_station_points_dict(stations_path):
     stations_df = pd.read_csv(stations_path)
     stations_df["geometry"] = [Point(xy) for xy in zip(stations_df.x, stations_df.y)]
     station_points_dict = stations_df.set_index("ID")["geometry"].to_dict()
     return station_points_dict
 
-def clustering_main():
-    cwd = os.getcwd()
-    net_flow_df_path = f"{cwd}/data/processed/net_flow_df.csv"
-    save_path = f"{cwd}/data/processed/points_gdf.gpkg"
-    stations_path = f"{cwd}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
-
-    station_points_dict = create_station_points_dict(stations_path)
-
-    net_flow_df = pd.read_csv(net_flow_df_path)
-    df = net_flow_df.pivot(columns="time", index="Departure station id", values="net_flow")
+def cluster_stations(net_flow_df, random_state=None):
+    df = net_flow_df.pivot(columns="hour", index="Departure station id", values="net_flow")
     df.fillna(0, inplace=True)
 
     scaler = StandardScaler()
     df.iloc[:,:] = scaler.fit_transform(df)
 
-    kmeans = KMeans(n_clusters=2)
+    kmeans = KMeans(n_clusters=2, random_state=random_state)
     kmeans.fit(df)
 
     df["group"] = kmeans.labels_
-    df = pd.DataFrame({"Departure station id":df.index, "group":df.group.tolist()})
+    return pd.DataFrame({"Departure station id":df.index, "group":df.group.tolist()})
+
+def profile_dir(mode):
+    return f"{storage.processed_dir()}/profiles/{mode}"
+
+def profile_features(station_days, mode):
+    '''
+    Standardized signed log2 net flows by hour, one float32 row per station and day (or weekday)
+    with trips. Returns the station ids and days (or weekdays, 0 is Monday) of the rows and the matrix.
+    '''
+    departures, returns = station_days.departures, station_days.returns
+    keys = station_days.days
+    if mode == "weekday":
+        weekdays = np.eye(7, dtype=np.float32)[station_days.weekdays]
+        departures = np.einsum("ndh,dw->nwh", departures, weekdays)
+        returns = np.einsum("ndh,dw->nwh", returns, weekdays)
+        keys = np.arange(7)
+
+    stations, rows = np.nonzero((np.asarray(departures).sum(axis=2) + np.asarray(returns).sum(axis=2)) > 0)
+    features = signed_log2(np.asarray(returns[stations, rows], dtype=np.float32) - np.asarray(departures[stations, rows], dtype=np.float32))
+
+    features -= features.mean(axis=0)
+    std = features.std(axis=0)
+    features /= np.where(std > 0, std, 1)
+    return station_days.station_ids[stations], keys[rows], features
+
+def fit_profiles(features, k, init=None, random_state=0):
+    kmeans = MiniBatchKMeans(n_clusters=k, init="k-means++" if init is None else init, n_init=3 if init is None else 1, batch_size=BATCH_SIZE, random_state=random_state)
+    return kmeans.fit(features)
+
+def score_k(features_path, k, random_state=0):
+    features = np.load(features_path)
+    kmeans = fit_profiles(features, k, random_state=random_state)
+    silhouette = silhouette_score(features, kmeans.labels_, sample_size=min(SILHOUETTE_SAMPLE, len(features)), random_state=random_state)
+    return {"k": k, "silhouette": float(silhouette), "inertia": float(kmeans.inertia_)}
+
+def select_k(features_path, ks=DEFAULT_KS, processes=None, random_state=0):
+    '''
+    Scores of every k, fitted in parallel processes that read the saved feature matrix.
+    '''
+    with ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(score_k, [features_path] * len(ks), ks, [random_state] * len(ks)))
+
+def previous_centroids(save_dir, station_ids, keys, features, k):
+    '''
+    Means of the features by the labels of the previous run, None if it had another k or a group lost all its profiles.
+    '''
+    if not os.path.exists(f"{save_dir}/labels.npy"):
+        return None
+    previous = pd.DataFrame({"station": np.load(f"{save_dir}/station_ids.npy"), "key": np.load(f"{save_dir}/keys.npy"), "label": np.load(f"{save_dir}/labels.npy")})
+    if previous["label"].nunique() != k:
+        return None
+
+    current = pd.DataFrame({"station": station_ids, "key": keys, "row": np.arange(len(keys))})
+    matched = current.merge(previous, on=["station", "key"])
+    sizes = np.bincount(matched["label"], minlength=k)
+    if (sizes == 0).any():
+        return None
+    sums = np.zeros((k, features.shape[1]), dtype=np.float64)
+    np.add.at(sums, matched["label"].to_numpy(), features[matched["row"].to_numpy()])
+    return (sums / sizes[:, None]).astype(np.float32)
+
+def cluster_profiles(station_days, mode, k=None, ks=DEFAULT_KS, processes=None, random_state=0):
+    save_dir = profile_dir(mode)
+    os.makedirs(save_dir, exist_ok=True)
+    station_ids, keys, features = profile_features(station_days, mode)
+    np.save(f"{save_dir}/features.npy", features)
+
+    scores = []
+    if k is None:
+        with measure("select_k", rows_in=len(features), mode=mode):
+            scores = select_k(f"{save_dir}/features.npy", [k for k in ks if k < len(features)], processes, random_state)
+        k = max(scores, key=lambda score: score["silhouette"])["k"]
+
+    init = previous_centroids(save_dir, station_ids, keys, features, k)
+    with measure("fit_profiles", rows_in=len(features), mode=mode, k=k, warm_start=init is not None):
+        kmeans = fit_profiles(features, k, init, random_state)
+
+    np.save(f"{save_dir}/station_ids.npy", station_ids)
+    np.save(f"{save_dir}/keys.npy", keys)
+    np.save(f"{save_dir}/labels.npy", kmeans.labels_.astype(np.int16))
+    np.save(f"{save_dir}/centroids.npy", kmeans.cluster_centers_.astype(np.float32))
+    with open(f"{save_dir}/model_selection.json", "w") as f:
+        json.dump({"k": k, "warm_start": init is not None, "scores": scores}, f, indent=2)
+
+def load_profile_groups(mode):
+    save_dir = profile_dir(mode)
+    return pd.DataFrame({
+        "Departure station id": np.load(f"{save_dir}/station_ids.npy"),
+        mode: np.load(f"{save_dir}/keys.npy"),
+        "group": np.load(f"{save_dir}/labels.npy"),
+    })
+
+def profile_clustering_main(modes=PROFILE_MODES, k=None, ks=DEFAULT_KS, processes=None):
+    station_days = StationDays.load()
+    for mode in modes:
+        cluster_profiles(station_days, mode, k, ks, processes)
+
+def clustering_main():
+    cwd = os.getcwd()
+    save_path = f"{cwd}/data/processed/points_gdf.gpkg"
+    stations_path = f"{cwd}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
+
+    station_points_dict = create_station_points_dict(stations_path)
+
+    net_flow_df = storage.read_table("net_flows", columns=["Departure station id", "hour", "net_flow"])
+    df = cluster_stations(net_flow_df)
 
     df["coords"] = df["Departure station id"].map(station_points_dict)
 
@@ -1,34 +1,36 @@
-import pandas as pd
-import os
+import numpy as np
+
+import storage
+from pair_keys import add_pair_key
+from od_tensor import ODTensor
+from time_bins import time_bins
 
 
 '''
 Transforms the trips dataframe into a dataframe with the columns: 
-Departure station id, Return station id, time, count, ids
+Departure station id, Return station id, hour, count, pair_key
 '''
 
 
 def get_data(path):
-    return pd.read_csv(path)
+    return storage.read_trips(columns=["Departure", "Departure station id", "Return station id", "Return"], path=path)
 
 def process_data(df):
-    df["Departure"] = pd.to_datetime(df["Departure"], format="mixed")
-    df["time"] = df["Departure"].dt.round(freq="60min").dt.time
+    df["hour"] = time_bins(df["Departure"].to_numpy().astype("datetime64[ms]").astype(np.int64), ["hour"])["hour"]
 
-    df = df.groupby(["Departure station id", "Return station id", "time"])["Return"].count().reset_index().rename(columns={"Return": "count"})
-    df["ids"] = df.apply(lambda row: tuple(sorted((int(row["Departure station id"]), int(row["Return station id"])))), axis=1)
+    df = df.groupby(["Departure station id", "Return station id", "hour"])["Return"].count().reset_index().rename(columns={"Return": "count"})
+    df = add_pair_key(df)
 
     return df
 
 def grouped_counts_main():
-    cwd = os.getcwd()
-    trips_path = f"{cwd}/data/processed/trips.csv"
-    save_path = f"{cwd}/data/processed/grouped_counts.csv"
+    trips_path = storage.trips_dir()
 
     grouped_counts_df = get_data(trips_path)
     grouped_counts_df = process_data(grouped_counts_df)
 
-    grouped_counts_df.to_csv(save_path, index=False)
+    storage.write_table(grouped_counts_df, "grouped_counts")
+    ODTensor.from_grouped_counts(grouped_counts_df).save()
 
 
 if __name__ == "__main__":
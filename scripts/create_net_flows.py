@@ -1,76 +1,117 @@
 import pandas as pd
-import geopandas as gpd
 import numpy as np
 import os
-from shapely.geometry import Point
+
+import storage
+from od_tensor import HOURS
 
 '''
 Use the grouped counts dataframe to calculate the net flow for each station
 (i.e. returns - departures)
 For the output dataframe we take log2(net flow + 1)
-'''
-
-def create_station_points_dict(stations_path):
-    stations_df = pd.read_csv(stations_path)
-    stations_df["geometry"] = [Point(xy) for xy in zip(stations_df.x, stations_df.y)]
-    station_points_dict = stations_df.set_index("ID")["geometry"].to_dict()
-    return station_points_dict
-
-def load_data(path):
-    return pd.read_csv(path)[["Departure station id", "Return station id", "time", "count"]]
-
-def create_departures_df(grouped_counts_df, station_points_dict):
-    data = grouped_counts_df.groupby(["Departure station id", "time"])["count"].sum().reset_index()
-    data["coords"] = data["Departure station id"].map(station_points_dict)
-    data = data.dropna()
-
-    data["lon"] = data["coords"].apply(lambda point: point.coords[0][0])
-    data["lat"] = data["coords"].apply(lambda point: point.coords[0][1])
-
-    data = data.rename(columns={"count": "departures"})
-
-    return data
 
-def create_returns_df(grouped_counts_df):
-    data = grouped_counts_df.groupby(["Return station id", "time"])["count"].sum().reset_index()
-    data = data.dropna()
-
-    data = data.rename(columns={"count": "returns"})
-
-    return data
-
-def create_net_flow_df(departures_df, returns_df):
-    net_flow_df = departures_df.merge(returns_df[["Return station id", "time", "returns"]], left_on=["Departure station id", "time"], right_on=["Return station id", "time"]).drop(columns=["Return station id"])
-
-    net_flow_df["net_flow"] = net_flow_df["returns"] - net_flow_df["departures"]
-    net_flow_df["sign"] = net_flow_df["net_flow"]
-    net_flow_df["net_flow"] = np.log2(np.abs(net_flow_df["net_flow"]) + 1)
-    net_flow_df["net_flow"] = np.copysign(net_flow_df["net_flow"], net_flow_df["sign"])
-    net_flow_df["volume"] = net_flow_df["departures"] + net_flow_df["returns"]
-    net_flow_df = net_flow_df.drop(columns=["sign"])
-    
-    return net_flow_df
+Departures and returns are counted with np.bincount into dense (station x hour) arrays,
+so every station gets all 24 hours, also the hours with departures but no returns or the
+other way round. Sums over an hour window are a reduction over the same arrays.
+'''
 
+def signed_log2(values):
+    values = np.asarray(values)
+    return np.copysign(np.log2(np.abs(values) + 1), values)
+
+
+class NetFlows():
+    def __init__(self, station_ids, departures, returns):
+        # departures and returns are (n_stations x 24) arrays in the order of station_ids
+        self.station_ids = station_ids
+        self.departures = departures
+        self.returns = returns
+
+    @classmethod
+    def from_grouped_counts(cls, grouped_counts_df):
+        dep_ids = grouped_counts_df["Departure station id"].to_numpy()
+        ret_ids = grouped_counts_df["Return station id"].to_numpy()
+        hours = grouped_counts_df["hour"].to_numpy().astype(np.int64)
+        counts = grouped_counts_df["count"].to_numpy()
+
+        station_ids = np.union1d(dep_ids, ret_ids).astype(np.int64)
+        size = len(station_ids) * HOURS
+
+        def station_hour_counts(ids):
+            codes = np.searchsorted(station_ids, ids) * HOURS + hours
+            return np.bincount(codes, weights=counts, minlength=size).astype(np.int64).reshape(-1, HOURS)
+
+        return cls(station_ids, station_hour_counts(dep_ids), station_hour_counts(ret_ids))
+
+    @classmethod
+    def from_od_tensor(cls, od_tensor):
+        return cls(od_tensor.station_ids, od_tensor.departures_by_hour(), od_tensor.returns_by_hour())
+
+    @property
+    def volume(self):
+        return self.departures + self.returns
+
+    @property
+    def net_flow(self):
+        return signed_log2(self.returns - self.departures)
+
+    def window(self, hours):
+        '''
+        Departures, returns, volume and net flow of every station summed over hours,
+        e.g. hour_window(23, 4) for the night.
+        '''
+        departures = self.departures[:, list(hours)].sum(axis=1)
+        returns = self.returns[:, list(hours)].sum(axis=1)
+        return pd.DataFrame({
+            "Departure station id": self.station_ids,
+            "departures": departures,
+            "returns": returns,
+            "volume": departures + returns,
+            "net_flow": signed_log2(returns - departures),
+        })
+
+    def to_frame(self, stations_df=None):
+        '''
+        The complete station x hour grid. With stations_df only the stations with coordinates
+        are kept and their lon and lat added.
+        '''
+        keep = np.ones(len(self.station_ids), dtype=bool)
+        if stations_df is not None:
+            coords = stations_df.drop_duplicates("ID").set_index("ID")[["x", "y"]]
+            keep = np.isin(self.station_ids, coords.index)
+        station_ids = self.station_ids[keep]
+
+        df = pd.DataFrame({
+            "Departure station id": np.repeat(station_ids, HOURS),
+            "hour": np.tile(np.arange(HOURS), len(station_ids)),
+            "departures": self.departures[keep].ravel(),
+            "returns": self.returns[keep].ravel(),
+            "volume": self.volume[keep].ravel(),
+            "net_flow": self.net_flow[keep].ravel(),
+        })
+        if stations_df is not None:
+            df["lon"] = np.repeat(coords.loc[station_ids, "x"].to_numpy(), HOURS)
+            df["lat"] = np.repeat(coords.loc[station_ids, "y"].to_numpy(), HOURS)
+        return df
+
+
+def load_data():
+    return storage.read_table("grouped_counts", columns=["Departure station id", "Return station id", "hour", "count"])
+
+def create_net_flow_df(grouped_counts_df, stations_df):
+    return NetFlows.from_grouped_counts(grouped_counts_df).to_frame(stations_df)
 
 
 def net_flows_main():
     cwd = os.getcwd()
-    grouped_counts_path = f"{cwd}/data/processed/grouped_counts.csv"
-    save_path = f"{cwd}/data/processed/net_flow_df.csv"
-    gdf_save_path = f"{cwd}/data/processed/net_flow_gdf.gpkg"
     stations_path = f"{cwd}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
 
-    station_points_dict = create_station_points_dict(stations_path)
-    grouped_counts_df = load_data(grouped_counts_path)
-
-    departures_df = create_departures_df(grouped_counts_df[["Departure station id", "time", "count"]], station_points_dict)
-    returns_df = create_returns_df(grouped_counts_df[["Return station id", "time", "count"]])
-
-    net_flow_df = create_net_flow_df(departures_df, returns_df)
+    stations_df = pd.read_csv(stations_path)
+    grouped_counts_df = load_data()
 
-    gpd.GeoDataFrame(net_flow_df, geometry="coords", crs="EPSG:4326").to_file(gdf_save_path)
+    net_flow_df = create_net_flow_df(grouped_counts_df, stations_df)
 
-    net_flow_df.to_csv(save_path, index=False)
+    storage.write_table(net_flow_df, "net_flows")
 
 if __name__ == "__main__":
-    net_flows_main()
\ No newline at end of file
+    net_flows_main()
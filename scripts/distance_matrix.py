@@ -0,0 +1,123 @@
+import os
+import json
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+
+from graph_store import GraphStore
+
+'''
+Station-to-station network distance matrix.
+
+Every station is snapped once to the graph store and one single-source Dijkstra per station
+fills its row of an (n_stations x n_stations) float32 matrix saved as a .npy file, so readers
+memory-map it instantly and look up pairs without NetworkX. Rows are computed in parallel,
+every worker writes its own rows straight into the file.
+Travel time is optional and assumes a constant riding speed.
+'''
+
+# about 16 km/h
+BIKE_SPEED_M_S = 4.5
+
+ROWS_PER_TASK = 16
+
+
+def station_index(stations_path):
+    stations_df = pd.read_csv(stations_path).sort_values("ID")
+    return stations_df["ID"].to_numpy(dtype=np.int64), stations_df["x"].to_numpy(), stations_df["y"].to_numpy()
+
+
+# set in each worker by init_worker
+_csgraph = None
+_station_nodes = None
+_distance_path = None
+
+def init_worker(graph_path, station_nodes, distance_path):
+    global _csgraph, _station_nodes, _distance_path
+    store = GraphStore(graph_path)
+    n = len(store.node_ids)
+    _csgraph = sp.csr_matrix((store.lengths, store.indices, store.indptr), shape=(n, n))
+    _station_nodes = station_nodes
+    _distance_path = distance_path
+
+def distance_rows(rows):
+    distances = dijkstra(_csgraph, directed=True, indices=_station_nodes[rows])[:, _station_nodes]
+
+    matrix = np.load(_distance_path, mmap_mode="r+")
+    matrix[rows] = distances.astype(np.float32)
+    matrix.flush()
+    return len(rows)
+
+
+def build_distance_matrix(graph_path, stations_path, save_dir, processes=None, with_travel_time=True, speed=BIKE_SPEED_M_S):
+    os.makedirs(save_dir, exist_ok=True)
+    station_ids, x, y = station_index(stations_path)
+    store = GraphStore(graph_path)
+    station_nodes = store.nearest_node_index(x, y)
+
+    distance_path = f"{save_dir}/distance.npy"
+    np.lib.format.open_memmap(distance_path, mode="w+", dtype=np.float32, shape=(len(station_ids), len(station_ids))).flush()
+
+    tasks = [np.arange(i, min(i + ROWS_PER_TASK, len(station_ids))) for i in range(0, len(station_ids), ROWS_PER_TASK)]
+    processes = processes or max(1, multiprocessing.cpu_count() - 2)
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(graph_path, station_nodes, distance_path)) as pool:
+        for _ in pool.imap_unordered(distance_rows, tasks):
+            pass
+
+    if with_travel_time:
+        distance = np.load(distance_path, mmap_mode="r")
+        travel_time = np.lib.format.open_memmap(f"{save_dir}/travel_time.npy", mode="w+", dtype=np.float32, shape=distance.shape)
+        travel_time[:] = distance / np.float32(speed)
+        travel_time.flush()
+
+    np.save(f"{save_dir}/station_ids.npy", station_ids)
+    with open(f"{save_dir}/meta.json", "w") as f:
+        json.dump({"graph_fingerprint": store.fingerprint, "stations": len(station_ids), "speed_m_s": speed if with_travel_time else None}, f, indent=2)
+
+
+class DistanceMatrix():
+    '''
+    Read-only view of a built matrix. Distances are meters, travel times seconds,
+    inf when the return station can not be reached and nan for unknown station ids.
+    '''
+    def __init__(self, save_dir):
+        with open(f"{save_dir}/meta.json") as f:
+            self.meta = json.load(f)
+        self.station_ids = np.load(f"{save_dir}/station_ids.npy")
+        self.distance = np.load(f"{save_dir}/distance.npy", mmap_mode="r")
+        travel_time_path = f"{save_dir}/travel_time.npy"
+        self.travel_time = np.load(travel_time_path, mmap_mode="r") if os.path.exists(travel_time_path) else None
+
+    def index(self, station_ids):
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.station_ids, station_ids), len(self.station_ids) - 1)
+        return np.where(self.station_ids[positions] == station_ids, positions, -1)
+
+    def lookup(self, dep_ids, ret_ids, values=None):
+        values = self.distance if values is None else values
+        dep, ret = self.index(dep_ids), self.index(ret_ids)
+        known = (dep >= 0) & (ret >= 0)
+
+        result = np.full(len(dep), np.nan, dtype=np.float32)
+        result[known] = values[dep[known], ret[known]]
+        return result
+
+    def lookup_travel_time(self, dep_ids, ret_ids):
+        if self.travel_time is None:
+            raise ValueError("The matrix was built without travel times")
+        return self.lookup(dep_ids, ret_ids, self.travel_time)
+
+
+def distance_matrix_main():
+    cwd = os.getcwd()
+    graph_path = f"{cwd}/data/processed/graph"
+    stations_path = f"{cwd}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
+    save_dir = f"{cwd}/data/processed/distance_matrix"
+
+    build_distance_matrix(graph_path, stations_path, save_dir)
+
+if __name__ == "__main__":
+    distance_matrix_main()
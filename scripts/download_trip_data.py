@@ -1,17 +1,38 @@
 import pandas as pd
-import requests
+import pyarrow as pa
+import pyarrow.parquet as pq
 import zipfile
 import os
 
+from storage import TRIP_SCHEMA
+from time_bins import add_time_bins
+from fetch import ensure_resource
+
 '''
-Downloads the trips dataset zip, unzips it and saves as csv.
+Downloads the trips dataset zip, unzips it and saves it as trip partitions (or as one csv in the legacy mode).
+
+The zip is streamed to disk by the fetch layer, only when it is missing. The streaming mode
+converts each monthly csv inside the zip into a typed parquet partition with the time bins
+of every trip, one row group per chunk of rows. Peak memory depends on the chunk size, not
+on the size of the year.
 '''
 
-def download_trip_data(data_url, zip_path, processed_csv_path) -> None:
-    r = requests.get(data_url)
-    with open(zip_path, "wb") as f:
-        f.write(r.content)
+ROWS_PER_CHUNK = 500_000
+
+# HSL writes ISO 8601 timestamps, parsing them with a fixed format is much faster than format="mixed"
+TIMESTAMP_FORMAT = "ISO8601"
+
+TRIP_CSV_DTYPES = {
+    "Departure station id": "Int16",
+    "Departure station name": "category",
+    "Return station id": "Int16",
+    "Return station name": "category",
+    "Covered distance (m)": "float32",
+    "Duration (sec.)": "float32",
+}
+
 
+def download_trip_data(zip_path, processed_csv_path) -> None:
     dfs = []
 
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
@@ -24,14 +45,65 @@ def download_trip_data(data_url, zip_path, processed_csv_path) -> None:
     trip_df.to_csv(processed_csv_path, index=False)
 
 
+def csv_members(zip_ref):
+    return [name for name in zip_ref.namelist() if name.endswith(".csv")]
+
+
+def partition_name(member_name):
+    return os.path.splitext(os.path.basename(member_name))[0]
+
+
+def prepare_chunk(chunk):
+    chunk["Departure"] = pd.to_datetime(chunk["Departure"], format=TIMESTAMP_FORMAT)
+    chunk["Return"] = pd.to_datetime(chunk["Return"], format=TIMESTAMP_FORMAT)
+
+    # rows without stations or timestamps are dropped by every groupby downstream anyway
+    chunk = chunk.dropna(subset=["Departure", "Return", "Departure station id", "Return station id"])
+    chunk = add_time_bins(chunk)
+    return pa.Table.from_pandas(chunk[TRIP_SCHEMA.names], schema=TRIP_SCHEMA, preserve_index=False, safe=False)
+
+
+def write_member_partition(zip_ref, member_name, partition_path, rows_per_chunk=ROWS_PER_CHUNK):
+    tmp_path = f"{partition_path}.part"
+    rows = 0
+
+    with zip_ref.open(member_name) as file, pq.ParquetWriter(tmp_path, TRIP_SCHEMA) as writer:
+        for chunk in pd.read_csv(file, dtype=TRIP_CSV_DTYPES, chunksize=rows_per_chunk):
+            table = prepare_chunk(chunk)
+            writer.write_table(table, row_group_size=rows_per_chunk)
+            rows += table.num_rows
+
+    os.replace(tmp_path, partition_path)
+    return rows
+
+
+def write_trip_partitions(zip_path, partitions_dir, rows_per_chunk=ROWS_PER_CHUNK, members=None):
+    '''
+    Converts the csv members of the zip into parquet partitions named after the member.
+    Returns a dict of partition name -> row count.
+    '''
+    os.makedirs(partitions_dir, exist_ok=True)
+    written = {}
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member_name in members if members is not None else csv_members(zip_ref):
+            name = partition_name(member_name)
+            partition_path = f"{partitions_dir}/{name}.parquet"
+            written[name] = write_member_partition(zip_ref, member_name, partition_path, rows_per_chunk)
+
+    return written
+
 
-def download_trip_data_main():
+def download_trip_data_main(streaming=True):
     cwd = os.getcwd()
-    trip_data_url = "https://dev.hsl.fi/citybikes/od-trips-2024/od-trips-2024.zip"
-    trip_zip_path = f"{cwd}/data/raw/od-trips-2024.zip"
+    trip_zip_path = ensure_resource("trips")
     trip_save_path = f"{cwd}/data/processed/trips.csv"
+    trip_partitions_dir = f"{cwd}/data/processed/trips"
 
-    download_trip_data(trip_data_url, trip_zip_path, trip_save_path)
+    if streaming:
+        write_trip_partitions(trip_zip_path, trip_partitions_dir)
+    else:
+        download_trip_data(trip_zip_path, trip_save_path)
 
 if __name__ == "__main__":
-    download_trip_data_main()
\ No newline at end of file
+    download_trip_data_main()
@@ -0,0 +1,104 @@
+import os
+import json
+
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+from route_store import RouteStore
+
+'''
+Sparse route-to-edge incidence matrix.
+
+Row i is the route of the i:th pair in the route store, column j an undirected road edge
+(a pair of graph store nodes) used by at least one route. With a vector of trip counts per route
+the traffic of every edge is a single sparse matrix-vector product.
+'''
+
+
+def route_edges(offsets, nodes):
+    '''
+    Consecutive node pairs of every route as (route row, smaller node, larger node).
+    '''
+    offsets = np.asarray(offsets)
+    nodes = np.asarray(nodes, dtype=np.int64)
+    lengths = np.diff(offsets)
+
+    # every position except the last node of each route starts an edge
+    starts = np.ones(len(nodes), dtype=bool)
+    starts[offsets[1:][lengths > 0] - 1] = False
+    starts = np.flatnonzero(starts)
+
+    rows = np.repeat(np.arange(len(lengths)), lengths)[starts]
+    a, b = nodes[starts], nodes[starts + 1]
+    return rows, np.minimum(a, b), np.maximum(a, b)
+
+
+def build_edge_incidence(route_store, save_dir):
+    rows, u, v = route_edges(route_store.offsets, route_store.nodes)
+    n_nodes = int(max(u.max(initial=0), v.max(initial=0))) + 1
+    edge_keys, columns = np.unique(u * n_nodes + v, return_inverse=True)
+
+    # a route that passes an edge twice counts its trips twice, like the exploded segments did
+    matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(len(route_store), len(edge_keys)))
+
+    os.makedirs(save_dir, exist_ok=True)
+    sp.save_npz(f"{save_dir}/matrix.npz", matrix)
+    np.save(f"{save_dir}/edge_u.npy", (edge_keys // n_nodes).astype(np.int32))
+    np.save(f"{save_dir}/edge_v.npy", (edge_keys % n_nodes).astype(np.int32))
+    with open(f"{save_dir}/meta.json", "w") as f:
+        json.dump(route_store_version(route_store), f, indent=2)
+
+def route_store_version(route_store):
+    return {
+        "graph_fingerprint": route_store.graph_fingerprint,
+        "routes": len(route_store),
+        "nodes": len(route_store.nodes),
+    }
+
+
+class EdgeIncidence():
+    def __init__(self, save_dir, route_store):
+        self.route_store = route_store
+        self.matrix = sp.load_npz(f"{save_dir}/matrix.npz").tocsr()
+        self.matrix_t = self.matrix.T.tocsr()
+        self.edge_u = np.load(f"{save_dir}/edge_u.npy")
+        self.edge_v = np.load(f"{save_dir}/edge_v.npy")
+        self.segments = None
+
+    @classmethod
+    def load(cls, save_dir, route_store_path):
+        '''
+        Loads the matrix, rebuilding it first if it is missing or was built from other routes.
+        '''
+        route_store = RouteStore(route_store_path)
+        meta_path = f"{save_dir}/meta.json"
+
+        stale = True
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                stale = json.load(f) != route_store_version(route_store)
+        if stale:
+            build_edge_incidence(route_store, save_dir)
+
+        return cls(save_dir, route_store)
+
+    def route_vector(self, pair_keys, counts):
+        '''
+        Sums counts per route row. Pairs without a route are left out.
+        '''
+        positions = self.route_store.positions(pair_keys)
+        found = positions >= 0
+        return np.bincount(positions[found], weights=np.asarray(counts, dtype=np.float64)[found], minlength=self.matrix.shape[0])
+
+    def edge_traffic(self, route_vector):
+        return self.matrix_t @ route_vector
+
+    def edge_segments(self, graph_store, decimals=4):
+        # two-point LineStrings of all edges, built once
+        if self.segments is None:
+            x = np.round(np.asarray(graph_store.x), decimals)
+            y = np.round(np.asarray(graph_store.y), decimals)
+            coords = np.stack([np.column_stack([x[self.edge_u], y[self.edge_u]]), np.column_stack([x[self.edge_v], y[self.edge_v]])], axis=1)
+            self.segments = shapely.linestrings(coords)
+        return self.segments
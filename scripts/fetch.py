@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+'''
+Fetches the remote raw inputs into data/raw.
+
+Every resource is streamed to disk in chunks next to a sidecar (<file>.fetch.json) holding its
+url, ETag, Last-Modified, size, mtime and sha256. Within MAX_AGE_SECONDS of the last check the
+local file is used without any request. After that the request is conditional on the ETag and
+Last-Modified, a 304 or a body with the same sha256 keeps the file as it is, so its mtime and the
+stages built from it stay up to date. Independent resources are fetched in parallel threads.
+The pipeline stages only fetch missing files, python scripts/fetch.py --refresh revalidates
+everything.
+
+CITY_BIKES_OFFLINE=1 serves everything from data/raw and fails on missing files. The base urls
+can be pointed elsewhere, e.g. a local stand-in server, with CITY_BIKES_HSL_URL and
+CITY_BIKES_ESPOO_WFS_URL.
+'''
+
+CHUNK_BYTES = 1 << 20
+MAX_AGE_SECONDS = 24 * 3600
+TIMEOUT_SECONDS = 60
+
+OFFLINE_ENV = "CITY_BIKES_OFFLINE"
+HSL_URL = os.environ.get("CITY_BIKES_HSL_URL", "https://dev.hsl.fi")
+ESPOO_WFS_URL = os.environ.get("CITY_BIKES_ESPOO_WFS_URL", "https://kartat.espoo.fi/teklaogcweb/wfs.ashx")
+
+# name -> (url, query parameters, path relative to the working directory)
+RESOURCES = {
+    "trips": (f"{HSL_URL}/citybikes/od-trips-2024/od-trips-2024.zip", None, "data/raw/od-trips-2024.zip"),
+    "espoo_areas": (ESPOO_WFS_URL, {
+        "service": "WFS",
+        "version": "1.1.0",
+        "request": "GetFeature",
+        "typename": "kanta:TilastollinenAlue",
+        "outputFormat": "GML3",
+        "srsname": "EPSG:4326",
+    }, "data/raw/tilastollinenalue_espoo.gml"),
+}
+
+
+def offline():
+    return os.environ.get(OFFLINE_ENV, "") not in ("", "0")
+
+def sidecar_path(path):
+    return f"{path}.fetch.json"
+
+def read_sidecar(path):
+    if not os.path.exists(sidecar_path(path)):
+        return {}
+    with open(sidecar_path(path)) as f:
+        return json.load(f)
+
+def write_sidecar(path, meta):
+    stat = os.stat(path)
+    meta = {**meta, "size": stat.st_size, "mtime": stat.st_mtime, "checked_at": time.time()}
+    with open(sidecar_path(path), "w") as f:
+        json.dump(meta, f, indent=2)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def local_sha256(path, meta):
+    '''
+    The sha256 of the sidecar when the file still has its size and mtime, otherwise recomputed.
+    '''
+    stat = os.stat(path)
+    if meta.get("size") == stat.st_size and meta.get("mtime") == stat.st_mtime and "sha256" in meta:
+        return meta["sha256"]
+    return file_sha256(path)
+
+
+def stream_to_file(response, path, chunk_size=CHUNK_BYTES):
+    '''
+    Writes the response body to path.part in chunks, returns the part path and its sha256.
+    '''
+    tmp_path = f"{path}.part"
+    digest = hashlib.sha256()
+    with open(tmp_path, "wb") as f:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+            digest.update(chunk)
+    return tmp_path, digest.hexdigest()
+
+def fetch(url, path, params=None, max_age=MAX_AGE_SECONDS, refresh=False):
+    '''
+    Makes path a current copy of the url. Returns True when the file was (re)written.
+    '''
+    if offline():
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} is not in the local cache and {OFFLINE_ENV} is set")
+        return False
+
+    meta = read_sidecar(path) if os.path.exists(path) else {}
+    # the validators only hold for the same request and an intact local copy
+    if meta.get("url") != url or meta.get("params") != params or local_sha256(path, meta) != meta.get("sha256"):
+        meta = {}
+    if meta and not refresh and time.time() - meta["checked_at"] < max_age:
+        return False
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with requests.get(url, params=params, headers=headers, stream=True, timeout=TIMEOUT_SECONDS) as r:
+        r.raise_for_status()
+        if r.status_code == 304:
+            write_sidecar(path, meta)
+            return False
+        tmp_path, sha256 = stream_to_file(r, path)
+        new_meta = {"url": url, "params": params, "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"), "sha256": sha256}
+
+    changed = not os.path.exists(path) or local_sha256(path, read_sidecar(path)) != sha256
+    if changed:
+        os.replace(tmp_path, path)
+    else:
+        os.remove(tmp_path)
+    write_sidecar(path, new_meta)
+    return changed
+
+def resource_path(name):
+    return f"{os.getcwd()}/{RESOURCES[name][2]}"
+
+def fetch_resource(name, refresh=False):
+    url, params, _ = RESOURCES[name]
+    return fetch(url, resource_path(name), params, refresh=refresh)
+
+def ensure_resource(name):
+    '''
+    Path of the resource, fetched only when it is missing so that pipeline stages make no requests.
+    '''
+    path = resource_path(name)
+    if not os.path.exists(path):
+        fetch_resource(name)
+    return path
+
+def fetch_all(names=None, refresh=False, max_workers=4):
+    '''
+    Fetches the resources in parallel threads. Returns a dict of name -> whether it changed.
+    '''
+    names = list(names or RESOURCES)
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = {name: executor.submit(fetch_resource, name, refresh) for name in names}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def fetch_main(names=None, refresh=False):
+    for name, changed in fetch_all(names, refresh).items():
+        print(f"{name}: {'updated' if changed else 'unchanged'}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetches the remote raw inputs into data/raw.")
+    parser.add_argument("names", nargs="*", help=f"resources to fetch ({', '.join(RESOURCES)}), all by default")
+    parser.add_argument("--refresh", action="store_true", help="revalidate even if checked recently")
+    args = parser.parse_args()
+
+    fetch_main(args.names, args.refresh)
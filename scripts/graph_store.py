@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import time
+
+import numpy as np
+import networkx as nx
+import osmnx as ox
+from sklearn.neighbors import BallTree
+
+from routing_pool import graph_to_csr
+from route_cache import graph_fingerprint
+from storage import replace_dir
+from instrumentation import measure
+
+'''
+Local store of the bike road graph.
+
+Nodes (id, x, y) and edges (u, v, length) are saved as typed .npy arrays together with
+the CSR arrays used for routing. Opening the store memory-maps the arrays, so it takes
+milliseconds and does not build any Python dict-of-dicts. NetworkX is rebuilt only on demand.
+
+The store is built from a local OSM extract (.osm xml, optionally .bz2) so it works offline.
+Without an extract the network is downloaded once with ox.graph_from_bbox and stored.
+'''
+
+STORE_ARRAYS = ("node_ids", "x", "y", "u", "v", "length", "indptr", "indices", "lengths")
+
+# the same exclusions as the osmnx "bike" network type
+BIKE_EXCLUDED_HIGHWAYS = re.compile("abandoned|bus_guideway|construction|corridor|elevator|escalator|footway|motor|no|planned|platform|proposed|raceway|razed|steps")
+
+
+def tag_values(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def is_bike_edge(data):
+    # like the osmnx bike filter, only highways are routable, not railways, buildings or landuse
+    if not tag_values(data.get("highway")):
+        return False
+    if any(BIKE_EXCLUDED_HIGHWAYS.search(str(value)) for value in tag_values(data.get("highway"))):
+        return False
+    if "yes" in tag_values(data.get("area")):
+        return False
+    if "private" in tag_values(data.get("access")) or "private" in tag_values(data.get("service")):
+        return False
+    return "no" not in tag_values(data.get("bicycle"))
+
+def graph_from_osm_extract(osm_path):
+    if "bicycle" not in ox.settings.useful_tags_way:
+        ox.settings.useful_tags_way = list(ox.settings.useful_tags_way) + ["bicycle"]
+
+    # filtered before simplifying, a simplified edge may join a cycleway with an excluded footway
+    G = ox.graph_from_xml(osm_path, bidirectional=False, simplify=False, retain_all=True)
+    G.remove_edges_from([(u, v, k) for u, v, k, data in G.edges(keys=True, data=True) if not is_bike_edge(data)])
+    G = ox.truncate.largest_component(G, strongly=False)
+    return ox.simplify_graph(G)
+
+
+def save_graph_store(G, store_dir, source):
+    arrays = graph_to_csr(G)
+
+    edges = list(G.edges(data="length"))
+    arrays["u"] = np.searchsorted(arrays["node_ids"], [u for u, _, _ in edges]).astype(np.int32)
+    arrays["v"] = np.searchsorted(arrays["node_ids"], [v for _, v, _ in edges]).astype(np.int32)
+    arrays["length"] = np.array([length for _, _, length in edges], dtype=np.float32)
+
+    # written aside and swapped in, other processes may have the current arrays memory-mapped
+    with replace_dir(store_dir) as tmp_dir:
+        for name in STORE_ARRAYS:
+            np.save(f"{tmp_dir}/{name}.npy", arrays[name])
+
+        with open(f"{tmp_dir}/meta.json", "w") as f:
+            json.dump({
+                "source": source,
+                "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "crs": str(G.graph.get("crs", "EPSG:4326")),
+                "nodes": len(arrays["node_ids"]),
+                "edges": len(edges),
+                "fingerprint": graph_fingerprint(arrays),
+            }, f, indent=2)
+
+def build_graph_store(store_dir, osm_path=None, bbox=None):
+    if osm_path is not None and os.path.exists(osm_path):
+        G = graph_from_osm_extract(osm_path)
+        source = osm_path
+    else:
+        G = ox.graph_from_bbox(bbox, network_type='bike')
+        source = f"bbox {bbox}"
+
+    save_graph_store(G, store_dir, source)
+
+
+class GraphStore():
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(f"{store_dir}/meta.json") as f:
+            self.meta = json.load(f)
+
+        for name in STORE_ARRAYS:
+            setattr(self, name, np.load(f"{store_dir}/{name}.npy", mmap_mode="r"))
+
+        self.fingerprint = self.meta["fingerprint"]
+        self.tree = None
+
+    @classmethod
+    def exists(cls, store_dir):
+        return os.path.exists(f"{store_dir}/meta.json")
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in STORE_ARRAYS}
+
+    def node_index(self, node_ids):
+        # node ids are stored sorted
+        return np.searchsorted(self.node_ids, node_ids)
+
+    def nearest_node_index(self, x, y):
+        '''
+        Index of the nearest node by great-circle distance, like ox.nearest_nodes on an unprojected graph.
+        '''
+        with measure("nearest_nodes", rows_in=len(x)):
+            if self.tree is None:
+                self.tree = BallTree(np.deg2rad(np.column_stack([self.y, self.x])), metric="haversine")
+            points = np.deg2rad(np.column_stack([np.asarray(y, dtype=np.float64), np.asarray(x, dtype=np.float64)]))
+            return self.tree.query(points, k=1, return_distance=False)[:, 0]
+
+    def nearest_nodes(self, x, y):
+        return np.asarray(self.node_ids)[self.nearest_node_index(x, y)]
+
+    def to_networkx(self):
+        G = nx.MultiDiGraph(crs=self.meta["crs"])
+        node_ids = np.asarray(self.node_ids)
+        G.add_nodes_from((int(node), {"x": float(x), "y": float(y)}) for node, x, y in zip(node_ids, self.x, self.y))
+        G.add_edges_from(
+            (int(node_ids[u]), int(node_ids[v]), {"length": float(length)})
+            for u, v, length in zip(self.u, self.v, self.length)
+        )
+        return G
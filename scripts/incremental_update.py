@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+import zipfile
+from functools import partial
+
+import pandas as pd
+import geopandas as gpd
+
+import storage
+from fetch import fetch_resource, resource_path
+from download_trip_data import csv_members, partition_name, write_trip_partitions
+from aggregate_trips import HourlyCounts, aggregate_partitions, write_products
+from calculate_paths import calculate_paths_main
+from clustering import clustering_main, profile_clustering_main
+from station_days import station_days_main
+from distance_matrix import distance_matrix_main
+
+from visuals.line_charts import trips_per_hour, net_flow_groups
+from visuals.night_life_map import night_life_map_main
+from visuals.path_graphs import path_graphs_main
+from visuals.segmented_map import segmented_map_main
+
+'''
+Incremental update for new months of trip data.
+
+Only zip members that are not yet in the manifest are ingested. Their counts are folded into
+the existing hourly counts, from which the pair counts and net flows are re-derived, and only
+station pairs without a saved route are routed. Downstream stages run only when the digest
+of one of their inputs changed since they were last built.
+
+The new months are recorded as pending in the manifest before their counts are folded in and
+moved to the folded partitions after the aggregates are written. If an update dies in between,
+the next one cannot tell whether the pending months are already in the aggregates, so it
+rebuilds them from all partitions instead of folding them a second time.
+'''
+
+def frame_digest(df):
+    return hashlib.sha256(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def input_digests():
+    processed = storage.processed_dir()
+    return {
+        "trips": lambda: hashlib.sha256(json.dumps({path: storage.partition_rows(path) for path in storage.trip_partitions()}).encode()).hexdigest(),
+        "station_days": lambda: "".join(file_digest(f"{processed}/station_days/{name}.npy") for name in ["station_ids", "first_day", "departures", "returns"]),
+        "net_flows": lambda: frame_digest(storage.read_table("net_flows")),
+        "od_tensor": lambda: file_digest(f"{processed}/od_tensor/station_ids.npy") + file_digest(f"{processed}/od_tensor/counts.npy"),
+        "routes": lambda: file_digest(f"{processed}/routes/pair_keys.npy") + file_digest(f"{processed}/routes/nodes.npy"),
+        # the gpkg file changes on every write, so the clustering result is compared by content
+        "points_gdf": lambda: frame_digest(gpd.read_file(f"{processed}/points_gdf.gpkg", ignore_geometry=True)[["Departure station id", "group"]]),
+    }
+
+# in dependency order, with the digests each stage reads and writes: clustering has to run
+# before the stages that read points_gdf, station_days before profile_clustering
+DOWNSTREAM_STAGES = [
+    ("clustering", ["net_flows"], ["points_gdf"], clustering_main),
+    ("station_days", ["trips"], ["station_days"], station_days_main),
+    ("profile_clustering", ["station_days"], [], profile_clustering_main),
+    ("distance_matrix", ["routes"], [], distance_matrix_main),
+    ("trips_per_hour", ["od_tensor"], [], trips_per_hour),
+    ("net_flow_groups", ["od_tensor", "points_gdf"], [], net_flow_groups),
+    ("night_life_map", ["od_tensor"], [], night_life_map_main),
+    ("path_graphs", ["od_tensor", "routes"], [], path_graphs_main),
+    ("path_tiles", ["od_tensor", "routes"], [], partial(path_graphs_main, backend="tiles")),
+    ("segmented_map", ["od_tensor", "points_gdf"], [], segmented_map_main),
+]
+
+
+def find_new_members(zip_path, manifest):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        return [member for member in csv_members(zip_ref) if partition_name(member) not in manifest["partitions"]]
+
+def fold_new_partitions(partition_paths, stations_path):
+    hourly_counts = aggregate_partitions(partition_paths)
+    if os.path.exists(storage.table_path("grouped_counts")):
+        existing = HourlyCounts.from_frame(storage.read_table("grouped_counts", columns=["Departure station id", "Return station id", "hour", "count"]))
+        hourly_counts = HourlyCounts.merge([existing, hourly_counts])
+    write_products(hourly_counts, stations_path)
+
+def recover_pending(manifest, stations_path):
+    '''
+    Rebuilds the aggregates from all partitions after an update that died while folding.
+    '''
+    partition_paths = storage.trip_partitions()
+    write_products(aggregate_partitions(partition_paths), stations_path)
+    manifest["partitions"] = {os.path.basename(path)[:-len(".parquet")]: storage.partition_rows(path) for path in partition_paths}
+    manifest["pending"] = {}
+    storage.write_manifest(manifest)
+
+def run_changed_stages(manifest):
+    digests = input_digests()
+    current = {}
+    ran = []
+
+    for stage, inputs, outputs, func in DOWNSTREAM_STAGES:
+        for name in inputs:
+            if name not in current:
+                current[name] = digests[name]()
+
+        wanted = {name: current[name] for name in inputs}
+        if manifest["stage_inputs"].get(stage) == wanted:
+            continue
+
+        func()
+        manifest["stage_inputs"][stage] = wanted
+        # recorded per stage, so an update that dies later does not redo the finished stages
+        storage.write_manifest(manifest)
+        ran.append(stage)
+
+        # outputs of this stage may be inputs of the following ones
+        for name in outputs:
+            current.pop(name, None)
+
+    return ran
+
+
+def incremental_update_main(download=True):
+    cwd = os.getcwd()
+    trip_zip_path = resource_path("trips")
+    stations_path = f"{cwd}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
+
+    manifest = storage.read_manifest()
+    if download:
+        # conditional on the ETag, an unchanged zip is not downloaded again
+        fetch_resource("trips", refresh=True)
+
+    if manifest.get("pending"):
+        print(f"Rebuilding the aggregates, an earlier update did not finish folding {list(manifest['pending'])}")
+        recover_pending(manifest, stations_path)
+
+    new_members = find_new_members(trip_zip_path, manifest)
+    print(f"New months: {[partition_name(member) for member in new_members]}")
+
+    if new_members:
+        written = write_trip_partitions(trip_zip_path, storage.trips_dir(), members=new_members)
+        manifest["pending"] = written
+        storage.write_manifest(manifest)
+
+        fold_new_partitions([f"{storage.trips_dir()}/{name}.parquet" for name in written], stations_path)
+        manifest["partitions"].update(written)
+        manifest["pending"] = {}
+        storage.write_manifest(manifest)
+
+        routed = calculate_paths_main(new_pairs_only=True)
+        print(f"Routed {routed} new station pairs")
+
+    ran = run_changed_stages(manifest)
+    print(f"Rebuilt: {ran}")
+
+if __name__ == "__main__":
+    incremental_update_main()
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import pstats
+import resource
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+'''
+Timing and memory instrumentation for the pipeline stages and their hot steps.
+
+measure() records wall time, CPU time, resident memory and optional row counts of a block.
+Records are kept per process: a stage collects the steps measured while it ran and returns
+them with its own record, so stages running in a process pool report their steps too.
+The pipeline writes all stage records of a run as one JSON run report, compare_reports lines
+up two reports to spot regressions. Stages can be run under cProfile on request.
+'''
+
+# records of the steps measured in this process since the last take_records
+_records = []
+
+
+def rss_mb():
+    # current resident set size, Linux only
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return None
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+@contextmanager
+def measure(name, rows_in=None, **extra):
+    '''
+    Measures the block and keeps its record. The yielded dict can be filled in the block,
+    e.g. record["rows_out"] = len(df).
+    '''
+    record = {"name": name, "pid": os.getpid(), **extra}
+    if rows_in is not None:
+        record["rows_in"] = int(rows_in)
+
+    rss_before = rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = time.perf_counter() - wall
+        record["cpu_seconds"] = time.process_time() - cpu
+        record["rss_before_mb"] = rss_before
+        record["rss_after_mb"] = rss_mb()
+        record["peak_rss_mb"] = peak_rss_mb()
+        record["children_peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+        _records.append(record)
+
+def record_workers(name, timings):
+    '''
+    Adds per-worker totals of the timing dicts (pid, seconds, max_rss_mb) returned by pool workers.
+    '''
+    workers = {}
+    for timing in timings:
+        worker = workers.setdefault(timing["pid"], {"pid": timing["pid"], "tasks": 0, "seconds": 0.0, "max_rss_mb": 0.0})
+        worker["tasks"] += 1
+        worker["seconds"] += timing["seconds"]
+        worker["max_rss_mb"] = max(worker["max_rss_mb"], timing.get("max_rss_mb", 0.0))
+    _records.append({"name": name, "pid": os.getpid(), "workers": sorted(workers.values(), key=lambda worker: worker["pid"])})
+
+def take_records():
+    records = list(_records)
+    _records.clear()
+    return records
+
+
+def profile_path(profile_dir, name):
+    return f"{profile_dir}/{name}.prof"
+
+def run_stage(name, func, kwargs, profile_dir=None):
+    '''
+    Runs a stage and returns its record with the records of its steps.
+    With profile_dir the stage runs under cProfile, the stats are saved as <stage>.prof
+    and the top functions by cumulative time go into the record.
+    '''
+    take_records()
+    profiler = cProfile.Profile() if profile_dir else None
+
+    with measure(name) as record:
+        if profiler:
+            profiler.enable()
+        try:
+            func(**kwargs)
+        finally:
+            if profiler:
+                profiler.disable()
+
+    # the stage record itself is the last one taken
+    record["steps"] = take_records()[:-1]
+
+    if profiler:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(profile_path(profile_dir, name))
+        record["profile"] = profile_path(profile_dir, name)
+        record["top_functions"] = top_functions(profiler)
+
+    return record
+
+def top_functions(profiler, n=20):
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:n]
+    return [{"function": f"{path}:{line}({func})", "calls": calls, "total_seconds": total, "cumulative_seconds": cumulative}
+            for (path, line, func), (_, calls, total, cumulative, _) in rows]
+
+
+def write_run_report(stage_records, report_dir, started):
+    os.makedirs(report_dir, exist_ok=True)
+    report = {
+        "started": started.isoformat(timespec="seconds"),
+        "finished": datetime.now().isoformat(timespec="seconds"),
+        "cpu_count": os.cpu_count(),
+        "stages": stage_records,
+    }
+    path = f"{report_dir}/run_{started.strftime('%Y%m%dT%H%M%S')}.json"
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+def compare_reports(old_path, new_path):
+    '''
+    Wall time, CPU time and peak memory of every stage and step in two run reports, with the ratios.
+    '''
+    def flatten(path):
+        with open(path) as f:
+            report = json.load(f)
+        rows = []
+        for stage in report["stages"]:
+            for record in [stage] + stage.get("steps", []):
+                if "wall_seconds" not in record:
+                    continue
+                name = stage["name"] if record is stage else f"{stage['name']}/{record['name']}"
+                rows.append({"name": name, "wall_seconds": record["wall_seconds"], "cpu_seconds": record["cpu_seconds"], "peak_rss_mb": record["peak_rss_mb"]})
+        # steps measured more than once in a stage are summed, the peak is the largest
+        return pd.DataFrame(rows).groupby("name").agg(wall_seconds=("wall_seconds", "sum"), cpu_seconds=("cpu_seconds", "sum"), peak_rss_mb=("peak_rss_mb", "max"))
+
+    df = flatten(old_path).join(flatten(new_path), lsuffix="_old", rsuffix="_new", how="outer")
+    for column in ["wall_seconds", "cpu_seconds", "peak_rss_mb"]:
+        df[f"{column}_ratio"] = df[f"{column}_new"] / df[f"{column}_old"]
+    return df.reset_index()
+
+if __name__ == "__main__":
+    import sys
+    print(compare_reports(sys.argv[1], sys.argv[2]).to_string(index=False))
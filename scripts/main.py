@@ -1,33 +1,26 @@
-from calculate_paths import calculate_paths_main
-from clustering import clustering_main
-from create_grouped_counts import grouped_counts_main
-from create_net_flows import net_flows_main
-from create_station_pairs import station_pairs_main
-from download_trip_data import download_trip_data_main
+import argparse
 
-from visuals.line_charts import trips_per_hour, net_flow_groups
-from visuals.night_life_map import night_life_map_main
-from visuals.path_graphs import path_graphs_main
-from visuals.segmented_map import segmented_map_main
+from pipeline import Pipeline
+from preview import preview_main
 
 import pandas as pd
 pd.options.mode.chained_assignment = None
 
-def load_and_process_data():
-    download_trip_data_main()
-    station_pairs_main()
-    grouped_counts_main()
-    net_flows_main()
-    calculate_paths_main(create_new_graph=True)
-    clustering_main()
+def main():
+    parser = argparse.ArgumentParser(description="Builds the data products and the visuals of the presentation.")
+    parser.add_argument("targets", nargs="*", help="stage names or output files like segmentation.png, everything by default")
+    parser.add_argument("--force", action="append", default=[], help="stage to run even if it is up to date, can be repeated")
+    parser.add_argument("--jobs", type=int, default=None, help="number of stages run at once")
+    parser.add_argument("--dry-run", action="store_true", help="only print which stages would run")
+    parser.add_argument("--profile", action="append", default=[], help="stage to run under cProfile, \"all\" for every stage, can be repeated")
+    parser.add_argument("--preview", action="store_true", help="run on a stratified sample of the trips in preview/, routing only the top pairs")
+    args = parser.parse_args()
 
-def create_visuals():
-    trips_per_hour()
-    net_flow_groups()
-    night_life_map_main()
-    path_graphs_main()
-    segmented_map_main()
+    if args.preview:
+        preview_main(args.targets, force=args.force, jobs=args.jobs)
+        return
+
+    Pipeline().run(args.targets, force=args.force, jobs=args.jobs, dry_run=args.dry_run, profile=args.profile)
 
 if __name__ == "__main__":
-    load_and_process_data()
-    create_visuals()
+    main()
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+import storage
+from pair_keys import encode_pair_key
+from time_bins import HOURS
+
+'''
+Dense (departure station x return station x hour) trip count tensor.
+
+Stations get dense indices in the order of their sorted ids. The tensor is built once from the
+grouped counts and saved as .npy, the marginals the visuals need (trips per hour, departures and
+returns per station, sums over a station set and an hour window) are NumPy reductions over it.
+'''
+
+
+class ODTensor():
+    def __init__(self, station_ids, counts):
+        self.station_ids = station_ids
+        self.counts = counts
+
+    @classmethod
+    def from_grouped_counts(cls, grouped_counts_df):
+        dep_ids = grouped_counts_df["Departure station id"].to_numpy()
+        ret_ids = grouped_counts_df["Return station id"].to_numpy()
+        station_ids = np.union1d(dep_ids, ret_ids).astype(np.int64)
+        n = len(station_ids)
+
+        flat = (np.searchsorted(station_ids, dep_ids) * n + np.searchsorted(station_ids, ret_ids)) * HOURS + grouped_counts_df["hour"].to_numpy()
+        counts = np.bincount(flat, weights=grouped_counts_df["count"].to_numpy(), minlength=n * n * HOURS)
+        return cls(station_ids, counts.astype(np.int32).reshape(n, n, HOURS))
+
+    @classmethod
+    def load(cls, save_dir=None):
+        save_dir = save_dir or default_dir()
+        return cls(np.load(f"{save_dir}/station_ids.npy"), np.load(f"{save_dir}/counts.npy", mmap_mode="r"))
+
+    def save(self, save_dir=None):
+        save_dir = save_dir or default_dir()
+        # the visuals and the query service memory-map the counts, a new tensor is swapped in whole
+        with storage.replace_dir(save_dir) as tmp_dir:
+            np.save(f"{tmp_dir}/station_ids.npy", self.station_ids)
+            np.save(f"{tmp_dir}/counts.npy", self.counts)
+
+    def index(self, station_ids):
+        '''
+        Dense indices of the station ids that appear in the tensor, unknown ids are left out.
+        '''
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.station_ids, station_ids), len(self.station_ids) - 1)
+        return positions[self.station_ids[positions] == station_ids]
+
+    def select(self, dep_stations=None, ret_stations=None, hours=None):
+        counts = self.counts
+        if dep_stations is not None:
+            counts = counts[self.index(dep_stations)]
+        if ret_stations is not None:
+            counts = counts[:, self.index(ret_stations)]
+        if hours is not None:
+            counts = counts[:, :, list(hours)]
+        return counts
+
+    def hourly_totals(self, dep_stations=None, ret_stations=None):
+        return self.select(dep_stations, ret_stations).sum(axis=(0, 1), dtype=np.int64)
+
+    def departures_by_hour(self):
+        return self.counts.sum(axis=1, dtype=np.int64)
+
+    def returns_by_hour(self):
+        return self.counts.sum(axis=0, dtype=np.int64)
+
+    def departures(self, hours=None):
+        return self.select(hours=hours).sum(axis=(1, 2), dtype=np.int64)
+
+    def returns(self, hours=None):
+        return self.select(hours=hours).sum(axis=(0, 2), dtype=np.int64)
+
+    def total(self, dep_stations=None, ret_stations=None, hours=None):
+        return int(self.select(dep_stations, ret_stations, hours).sum(dtype=np.int64))
+
+    def pair_counts(self, dep_stations, hours=None):
+        '''
+        Trips from dep_stations to every return station during hours as a frame of
+        Departure station id, Return station id, count and pair_key, zero counts left out.
+        '''
+        dep_index = self.index(dep_stations)
+        counts = self.counts[dep_index]
+        if hours is not None:
+            counts = counts[:, :, list(hours)]
+        counts = counts.sum(axis=2, dtype=np.int64)
+
+        dep, ret = np.nonzero(counts)
+        df = pd.DataFrame({
+            "Departure station id": self.station_ids[dep_index[dep]],
+            "Return station id": self.station_ids[ret],
+            "count": counts[dep, ret],
+        })
+        df["pair_key"] = encode_pair_key(df["Departure station id"], df["Return station id"])
+        return df
+
+    def top_destinations(self, dep_stations, hours=None, n=10):
+        df = self.pair_counts(dep_stations, hours)
+        return df.groupby("Return station id")["count"].sum().nlargest(n).reset_index()
+
+
+def default_dir():
+    return f"{storage.processed_dir()}/od_tensor"
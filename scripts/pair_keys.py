@@ -0,0 +1,20 @@
+import numpy as np
+
+'''
+Undirected station pair keys.
+A pair of station ids is packed into a single int64 as (min << 32) | max,
+so trips a -> b and b -> a share the same key and the same route.
+'''
+
+def encode_pair_key(dep_ids, ret_ids):
+    dep_ids = np.asarray(dep_ids, dtype=np.int64)
+    ret_ids = np.asarray(ret_ids, dtype=np.int64)
+    return (np.minimum(dep_ids, ret_ids) << 32) | np.maximum(dep_ids, ret_ids)
+
+def decode_pair_key(keys):
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys >> 32, keys & 0xFFFFFFFF
+
+def add_pair_key(df, dep_column="Departure station id", ret_column="Return station id"):
+    df["pair_key"] = encode_pair_key(df[dep_column].to_numpy(), df[ret_column].to_numpy())
+    return df
@@ -0,0 +1,222 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+import storage
+from instrumentation import run_stage, write_run_report
+from aggregate_trips import aggregate_trips_main
+from calculate_paths import calculate_paths_main
+from clustering import clustering_main, profile_clustering_main
+from station_days import station_days_main
+from distance_matrix import distance_matrix_main
+from download_trip_data import download_trip_data_main
+from area_layer import area_layer_main
+
+from visuals.line_charts import trips_per_hour, net_flow_groups
+from visuals.night_life_map import night_life_map_main
+from visuals.path_graphs import path_graphs_main
+from visuals.segmented_map import segmented_map_main
+
+'''
+Runs the pipeline stages in dependency order.
+
+Every stage declares the files or directories it reads and writes, paths relative to the
+working directory. A stage depends on the stages that write its inputs. It is skipped when
+all its outputs exist, are newer than all its inputs and the hash of its function and
+keyword arguments is the one it was last built with. Stages whose dependencies are done
+run concurrently in a process pool. Stages marked exclusive start worker pools of their own
+sized to the machine (routing, the distance matrix, the k selection, the map rendering), so
+they run alone: nothing else is started while one runs, and one starts only when nothing
+else is running. With targets, given as stage names or output file names
+like segmentation.png, only those stages and the stages they depend on are considered.
+Every run that builds something writes a JSON run report to data/processed/reports.
+'''
+
+STATIONS_PATH = "data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
+PATH_GRAPH_MAPS = ["herttoniemi_morning", "herttoniemi_afternoon", "steissi_morning", "steissi_afternoon", "vuosaari", "pajamäki", "tapanila"]
+
+
+class Stage():
+    def __init__(self, name, func, inputs, outputs, config=None, exclusive=False):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.config = config or {}
+        self.exclusive = exclusive
+
+    @property
+    def config_hash(self):
+        description = {"func": f"{self.func.__module__}.{self.func.__name__}", "config": self.config}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def run(self, profile_dir=None):
+        return run_stage(self.name, self.func, self.config, profile_dir)
+
+
+STAGES = [
+    # the zip is only downloaded when missing, scripts/fetch.py --refresh revalidates the remote inputs
+    Stage("download_trip_data", download_trip_data_main, ["data/raw/od-trips-2024.zip"], ["data/processed/trips"]),
+    Stage("aggregate_trips", aggregate_trips_main, ["data/processed/trips", STATIONS_PATH],
+          ["data/processed/grouped_counts.parquet", "data/processed/station_pair_counts.parquet", "data/processed/net_flows.parquet", "data/processed/od_tensor"]),
+    # the graph store is built by the routing stage when it is missing, the routes stand in for it downstream
+    Stage("calculate_paths", calculate_paths_main, ["data/processed/station_pair_counts.parquet"],
+          ["data/processed/routes", "data/processed/edge_incidence"], {"routing_mode": "origin"}, exclusive=True),
+    Stage("distance_matrix", distance_matrix_main, ["data/processed/routes", STATIONS_PATH], ["data/processed/distance_matrix"], exclusive=True),
+    Stage("clustering", clustering_main, ["data/processed/net_flows.parquet", STATIONS_PATH], ["data/processed/points_gdf.gpkg"]),
+    Stage("station_days", station_days_main, ["data/processed/trips"], ["data/processed/station_days"]),
+    Stage("profile_clustering", profile_clustering_main, ["data/processed/station_days"],
+          ["data/processed/profiles/day", "data/processed/profiles/weekday"], {"modes": ["day", "weekday"]}, exclusive=True),
+    Stage("trips_per_hour", trips_per_hour, ["data/processed/od_tensor"], ["presentation/trips_per_hour.html"]),
+    Stage("net_flow_groups", net_flow_groups, ["data/processed/od_tensor", "data/processed/points_gdf.gpkg"], ["presentation/net_flow_groups.html"]),
+    Stage("night_life_map", night_life_map_main, ["data/processed/od_tensor", STATIONS_PATH], ["presentation/night_life.png"]),
+    Stage("path_graphs", path_graphs_main, ["data/processed/od_tensor", "data/processed/routes", "data/processed/edge_incidence", STATIONS_PATH],
+          [f"presentation/{name}.png" for name in PATH_GRAPH_MAPS], exclusive=True),
+    Stage("path_tiles", path_graphs_main, ["data/processed/od_tensor", "data/processed/routes", "data/processed/edge_incidence", STATIONS_PATH],
+          [f"presentation/tiles/{name}" for name in PATH_GRAPH_MAPS], config={"backend": "tiles"}),
+    Stage("area_layer", area_layer_main, ["data/raw/tilastollinenalue_espoo.gml", "data/raw/pienalueet_WFS.gpkg", "data/raw/meri"], ["data/processed/areas"]),
+    Stage("segmented_map", segmented_map_main, ["data/processed/od_tensor", "data/processed/points_gdf.gpkg", "data/processed/areas", STATIONS_PATH],
+          ["presentation/segmentation.png"]),
+]
+
+
+def newest_mtime(path):
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+    mtimes = [os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    return max(mtimes, default=os.path.getmtime(path))
+
+def oldest_mtime(path):
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+    mtimes = [os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    return min(mtimes, default=None)
+
+
+def reports_dir():
+    return f"{storage.processed_dir()}/reports"
+
+def state_path():
+    return f"{storage.processed_dir()}/pipeline_state.json"
+
+def read_state():
+    if not os.path.exists(state_path()):
+        return {}
+    with open(state_path()) as f:
+        return json.load(f)
+
+def write_state(state):
+    os.makedirs(os.path.dirname(state_path()), exist_ok=True)
+    with open(state_path(), "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+class Pipeline():
+    def __init__(self, stages=STAGES):
+        self.stages = {stage.name: stage for stage in stages}
+        self.writers = {output: stage.name for stage in stages for output in stage.outputs}
+
+    def dependencies(self, name):
+        return {self.writers[path] for path in self.stages[name].inputs if path in self.writers}
+
+    def resolve(self, targets=None):
+        '''
+        Names of the stages needed for targets, all stages by default.
+        '''
+        if not targets:
+            return set(self.stages)
+
+        needed = set()
+        pending = []
+        for target in targets:
+            if target in self.stages:
+                pending.append(target)
+                continue
+            matches = [stage for path, stage in self.writers.items() if path == target or os.path.basename(path) == target]
+            if not matches:
+                raise ValueError(f"Unknown target {target}")
+            pending.extend(matches)
+
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.dependencies(name))
+        return needed
+
+    def is_up_to_date(self, stage, state):
+        # outputs built before the pipeline kept state are taken as they are
+        if state.get(stage.name, stage.config_hash) != stage.config_hash:
+            return False
+        if not all(os.path.exists(path) for path in stage.outputs):
+            return False
+
+        output_mtimes = [oldest_mtime(path) for path in stage.outputs]
+        if None in output_mtimes:
+            return False
+        input_mtimes = [newest_mtime(path) for path in stage.inputs if os.path.exists(path)]
+        return min(output_mtimes, default=0) >= max(input_mtimes, default=0)
+
+    def run(self, targets=None, force=(), jobs=None, dry_run=False, profile=()):
+        '''
+        Runs the out of date stages needed for targets. force names stages that run regardless,
+        profile the stages run under cProfile, "all" for every stage.
+        Returns the names of the stages that ran, or would run with dry_run.
+        '''
+        started = datetime.now()
+        records = []
+        needed = self.resolve(targets)
+        state = read_state()
+        done, ran = set(), []
+        running = {}
+
+        def ready():
+            return [name for name in sorted(needed - done - set(running.values())) if self.dependencies(name) & needed <= done]
+
+        def held_back(stage):
+            # a stage with a worker pool of its own runs alone
+            if any(self.stages[name].exclusive for name in running.values()):
+                return True
+            return stage.exclusive and bool(running)
+
+        # a fresh process per stage, the peak memory of a reused worker would be that of its largest earlier stage
+        with ProcessPoolExecutor(jobs or max(1, os.cpu_count() - 2), max_tasks_per_child=1) as executor:
+            while len(done) < len(needed):
+                for name in ready():
+                    stage = self.stages[name]
+                    upstream_ran = bool(self.dependencies(name) & set(ran))
+                    if name not in force and not upstream_ran and self.is_up_to_date(stage, state):
+                        print(f"{name}: up to date")
+                        state[name] = stage.config_hash
+                        done.add(name)
+                    elif dry_run:
+                        print(f"{name}: would run")
+                        ran.append(name)
+                        done.add(name)
+                    elif held_back(stage):
+                        continue
+                    else:
+                        print(f"{name}: running")
+                        profile_dir = f"{reports_dir()}/profiles_{started.strftime('%Y%m%dT%H%M%S')}" if name in profile or "all" in profile else None
+                        running[executor.submit(stage.run, profile_dir)] = name
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    records.append(future.result())
+                    state[name] = self.stages[name].config_hash
+                    write_state(state)
+                    ran.append(name)
+                    done.add(name)
+                    print(f"{name}: done in {records[-1]['wall_seconds']:.1f} s")
+
+        if not dry_run:
+            write_state(state)
+        if records:
+            print(f"Run report: {write_run_report(records, reports_dir(), started)}")
+        return ran
@@ -0,0 +1,246 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+import storage
+from aggregate_trips import HourlyCounts, pack_keys, iter_trip_batches, batch_rows, write_products, MEMORY_BUDGET_MB
+from od_tensor import ODTensor, HOURS, default_dir
+from create_net_flows import NetFlows, signed_log2
+from clustering import cluster_stations
+from edge_incidence import EdgeIncidence
+from pair_keys import encode_pair_key
+from visuals.night_life_map import NIGHT_HOURS
+from pipeline import STAGES, STATIONS_PATH, Stage, Pipeline
+
+'''
+Preview of the whole pipeline on a sample of the trips.
+
+Trips are sampled independently with a probability set per (departure station, hour) stratum:
+the sample fraction, raised so that every stratum keeps at least MIN_PER_STRATUM trips.
+Every sampled trip carries the weight 1 / p, so weighted counts estimate the full counts
+and, being sums of independent trips, their variance is estimated by the sum of w^2 - w.
+The estimated counts go through the normal stages in a separate workspace (preview/),
+only the TOP_PAIRS pairs with the most trips are routed. preview_report.json holds the
+sample size and 95 % error bounds for every output.
+'''
+
+PREVIEW_DIR = "preview"
+SAMPLE_FRACTION = 0.02
+MIN_PER_STRATUM = 5
+TOP_PAIRS = 2000
+CLUSTER_RESAMPLES = 10
+Z_95 = 1.96
+
+# station ids are int16
+STRATUM_STATIONS = 1 << 15
+
+
+def stratum_codes(dep_ids, hours):
+    return dep_ids.astype(np.int64) * HOURS + hours
+
+def stratum_sizes(partition_paths, rows):
+    sizes = np.zeros(STRATUM_STATIONS * HOURS, dtype=np.int64)
+    for dep_ids, _, bins in iter_trip_batches(partition_paths, rows):
+        sizes += np.bincount(stratum_codes(dep_ids, bins["hour"]), minlength=len(sizes))
+    return sizes
+
+def inclusion_probabilities(sizes, fraction=SAMPLE_FRACTION, min_per_stratum=MIN_PER_STRATUM):
+    with np.errstate(divide="ignore"):
+        probabilities = np.maximum(fraction, min_per_stratum / sizes)
+    return np.minimum(probabilities, 1.0)
+
+def sample_trips(partition_paths, fraction=SAMPLE_FRACTION, min_per_stratum=MIN_PER_STRATUM, seed=0, memory_budget_mb=MEMORY_BUDGET_MB):
+    '''
+    Weighted (dep, ret, hour) counts of a stratified sample of the trips.
+    Returns the grouped counts with count (the rounded estimate), estimate and variance columns,
+    and a summary of the sample.
+    '''
+    rows = batch_rows(memory_budget_mb)
+    sizes = stratum_sizes(partition_paths, rows)
+    probabilities = inclusion_probabilities(sizes, fraction, min_per_stratum)
+    rng = np.random.default_rng(seed)
+
+    keys, weights = [], []
+    for dep_ids, ret_ids, bins in iter_trip_batches(partition_paths, rows):
+        hours = bins["hour"].astype(np.int64)
+        p = probabilities[stratum_codes(dep_ids, hours)]
+        sampled = rng.random(len(p)) < p
+        keys.append(pack_keys(dep_ids[sampled], ret_ids[sampled], hours[sampled]))
+        weights.append(1 / p[sampled])
+
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    weights = np.concatenate(weights)
+    estimate = np.bincount(inverse, weights=weights, minlength=len(keys))
+    variance = np.bincount(inverse, weights=weights**2 - weights, minlength=len(keys))
+
+    df = HourlyCounts(keys, np.maximum(np.round(estimate), 1).astype(np.int64)).to_frame()
+    df["estimate"] = estimate
+    df["variance"] = variance
+
+    summary = {
+        "trips": int(sizes.sum()),
+        "sampled_trips": int(len(weights)),
+        "strata": int((sizes > 0).sum()),
+        "sample_fraction": fraction,
+        "min_per_stratum": min_per_stratum,
+    }
+    return df, summary
+
+
+def variance_path():
+    return f"{default_dir()}/variance.npy"
+
+def sample_path():
+    return f"{storage.processed_dir()}/preview_sample.json"
+
+def preview_sample_main(trips_dir, fraction=SAMPLE_FRACTION, min_per_stratum=MIN_PER_STRATUM, seed=0):
+    '''
+    Writes the estimated aggregate tables and OD tensor of the preview workspace, with the
+    variances of the tensor counts next to it.
+    '''
+    cwd = os.getcwd()
+    stations_path = f"{cwd}/{STATIONS_PATH}"
+
+    grouped_counts_df, summary = sample_trips(storage.trip_partitions(trips_dir), fraction, min_per_stratum, seed)
+    write_products(HourlyCounts.from_frame(grouped_counts_df), stations_path)
+
+    # variances of the tensor cells, in the station order of the tensor
+    od_tensor = ODTensor.load()
+    n = len(od_tensor.station_ids)
+    cells = (od_tensor.index(grouped_counts_df["Departure station id"]) * n + od_tensor.index(grouped_counts_df["Return station id"])) * HOURS + grouped_counts_df["hour"].to_numpy()
+    variance = np.bincount(cells, weights=grouped_counts_df["variance"].to_numpy(), minlength=n * n * HOURS).reshape(n, n, HOURS)
+    np.save(variance_path(), variance.astype(np.float32))
+    with open(sample_path(), "w") as f:
+        json.dump(summary, f, indent=2)
+
+
+def quantiles(values):
+    if len(values) == 0:
+        return {"median": None, "p90": None}
+    return {"median": float(np.median(values)), "p90": float(np.quantile(values, 0.9))}
+
+def relative_ci(estimate, variance):
+    estimate = np.asarray(estimate, dtype=np.float64)
+    used = estimate > 0
+    return quantiles(Z_95 * np.sqrt(np.asarray(variance, dtype=np.float64)[used]) / estimate[used])
+
+def log2_interval(values, variance):
+    # signed_log2 is monotonic, so the interval of the count maps to the interval of the net flow
+    half_width = Z_95 * np.sqrt(variance)
+    return signed_log2(values - half_width), signed_log2(values + half_width)
+
+def cluster_stability(net_flows, dep_variance, ret_variance, resamples=CLUSTER_RESAMPLES, seed=0):
+    '''
+    Share of stations that keep their cluster when the counts are redrawn within their error.
+    '''
+    rng = np.random.default_rng(seed)
+    base = cluster_stations(net_flows.to_frame(), random_state=seed).set_index("Departure station id")["group"]
+
+    agreements = []
+    for _ in range(resamples):
+        departures = np.maximum(net_flows.departures + rng.normal(0, 1, dep_variance.shape) * np.sqrt(dep_variance), 0)
+        returns = np.maximum(net_flows.returns + rng.normal(0, 1, ret_variance.shape) * np.sqrt(ret_variance), 0)
+        groups = cluster_stations(NetFlows(net_flows.station_ids, departures, returns).to_frame(), random_state=seed).set_index("Departure station id")["group"]
+        agreement = (groups.loc[base.index] == base).mean()
+        # the cluster labels are arbitrary
+        agreements.append(max(agreement, 1 - agreement))
+    return {"mean": float(np.mean(agreements)), "min": float(np.min(agreements))}
+
+def preview_report_main():
+    cwd = os.getcwd()
+    od_tensor = ODTensor.load()
+    variance = np.load(variance_path(), mmap_mode="r").astype(np.float64)
+    with open(sample_path()) as f:
+        report = {"sample": json.load(f)}
+
+    hourly = od_tensor.hourly_totals()
+    hourly_se = np.sqrt(variance.sum(axis=(0, 1)))
+    report["trips_per_hour"] = [{"hour": hour, "estimate": int(hourly[hour]), "ci95": float(Z_95 * hourly_se[hour])} for hour in range(HOURS)]
+
+    net_flows = NetFlows.from_od_tensor(od_tensor)
+    dep_variance, ret_variance = variance.sum(axis=1), variance.sum(axis=0)
+    net_variance = dep_variance + ret_variance
+    report["net_flows"] = {
+        "departures_relative_ci95": relative_ci(net_flows.departures, dep_variance),
+        "returns_relative_ci95": relative_ci(net_flows.returns, ret_variance),
+        "net_flow_log2_ci95": quantiles(np.subtract(*log2_interval(net_flows.returns - net_flows.departures, net_variance)[::-1])[net_flows.volume > 0] / 2),
+    }
+
+    night_departures = net_flows.departures[:, NIGHT_HOURS].sum(axis=1)
+    night_returns = net_flows.returns[:, NIGHT_HOURS].sum(axis=1)
+    night_net = night_returns - night_departures
+    night_low, night_high = log2_interval(night_net, net_variance[:, NIGHT_HOURS].sum(axis=1))
+    # stations whose side of the map threshold (net flow < -8) is not certain
+    report["night_life_map"] = {
+        "shown_stations": int((signed_log2(night_net) < -8).sum()),
+        "uncertain_stations": int(((night_low < -8) & (night_high >= -8)).sum()),
+    }
+
+    report["clustering"] = {"assignment_stability": cluster_stability(net_flows, dep_variance, ret_variance)}
+
+    incidence = EdgeIncidence.load(f"{cwd}/data/processed/edge_incidence", f"{cwd}/data/processed/routes")
+    dep, ret = np.nonzero(od_tensor.counts.sum(axis=2))
+    pair_counts = pd.DataFrame({
+        "Departure station id": od_tensor.station_ids[dep],
+        "Return station id": od_tensor.station_ids[ret],
+        "count": od_tensor.counts.sum(axis=2)[dep, ret],
+        "variance": variance.sum(axis=2)[dep, ret],
+    })
+    pair_keys = encode_pair_key(pair_counts["Departure station id"], pair_counts["Return station id"])
+    routed = incidence.route_store.positions(pair_keys) >= 0
+    edge_traffic = incidence.edge_traffic(incidence.route_vector(pair_keys, pair_counts["count"]))
+    edge_variance = incidence.matrix_t.multiply(incidence.matrix_t) @ incidence.route_vector(pair_keys, pair_counts["variance"])
+    report["path_graphs"] = {
+        "routed_pairs": int(len(incidence.route_store)),
+        "routed_trip_share": float(pair_counts["count"][routed].sum() / pair_counts["count"].sum()),
+        "edge_traffic_relative_ci95": relative_ci(edge_traffic, edge_variance),
+    }
+
+    with open(f"{cwd}/preview_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def preview_stages(trips_dir, fraction=SAMPLE_FRACTION, top_pairs=TOP_PAIRS):
+    '''
+    The pipeline stages for the preview workspace: the sample replaces the download and the
+    full aggregation, routing is limited to the top pairs and the report comes last. The
+    distance matrix and the station-day profiles are left out.
+    '''
+    stages = []
+    for stage in STAGES:
+        if stage.name in ("download_trip_data", "distance_matrix", "station_days", "profile_clustering"):
+            continue
+        if stage.name == "aggregate_trips":
+            stage = Stage("preview_sample", preview_sample_main, [trips_dir, STATIONS_PATH], stage.outputs, {"trips_dir": trips_dir, "fraction": fraction})
+        elif stage.name == "calculate_paths":
+            stage = Stage(stage.name, stage.func, stage.inputs, stage.outputs, {**stage.config, "top_pairs": top_pairs}, stage.exclusive)
+        stages.append(stage)
+
+    stages.append(Stage("preview_report", preview_report_main, ["data/processed/od_tensor", "data/processed/routes", "data/processed/edge_incidence", "data/processed/points_gdf.gpkg"], ["preview_report.json"]))
+    return stages
+
+def prepare_preview_workspace(root, workspace):
+    '''
+    The preview workspace shares the raw data and the graph store of the full run.
+    '''
+    os.makedirs(f"{workspace}/data/processed", exist_ok=True)
+    os.makedirs(f"{workspace}/presentation", exist_ok=True)
+    for path in ["data/raw", "data/processed/graph"]:
+        if os.path.exists(f"{root}/{path}") and not os.path.lexists(f"{workspace}/{path}"):
+            os.symlink(f"{root}/{path}", f"{workspace}/{path}")
+
+def preview_main(targets=None, force=(), jobs=None, fraction=SAMPLE_FRACTION, top_pairs=TOP_PAIRS):
+    root = os.getcwd()
+    workspace = f"{root}/{PREVIEW_DIR}"
+    prepare_preview_workspace(root, workspace)
+
+    os.chdir(workspace)
+    try:
+        return Pipeline(preview_stages(f"{root}/data/processed/trips", fraction, top_pairs)).run(targets, force=force, jobs=jobs)
+    finally:
+        os.chdir(root)
+
+if __name__ == "__main__":
+    preview_main()
@@ -0,0 +1,297 @@
+import io
+import os
+import math
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from branca.colormap import LinearColormap
+
+from time_bins import HOURS, hour_window
+from create_net_flows import NetFlows
+from visuals.path_graphs import DataProcessor, COLORS
+from visuals.utils import render_static_map
+
+'''
+Local HTTP service answering flow queries for any station set and hour window.
+
+The OD tensor, the station table, the route-to-edge incidence and the edge segments are loaded
+once when the service starts. Every query is then a slice of the tensor and a sparse
+matrix-vector product, so new station groups can be explored without editing path_graphs.py
+or rerunning anything. Requests are handled in threads, and finished responses are kept in an
+LRU cache keyed by the normalized query. GeoJSON answers take tens of milliseconds. A PNG is
+drawn by the static map renderer, one at a time, and takes around 100-150 ms until it is cached.
+
+GET /edge_flows?stations=19,21,22&hours=6-10          trips over every road edge
+GET /net_flow?stations=19,21,22&hours=23-4            departures, returns and net_flow_log2, the signed log2 of
+                                                      returns - departures, per station, all stations without stations
+GET /top_destinations?stations=317&hours=6-10&n=10    the busiest return stations
+
+hours is a comma separated list of hours and ranges, a range may wrap around midnight (23-4),
+all hours by default. format=geojson (default) or format=png, with zoom (0-22), lat and lon for
+the png view centered on the selected stations by default. Bad parameters get a 400, station
+sets without any known station a 404. Run with python scripts/query_service.py from the
+project root after the pipeline has built od_tensor, routes and edge_incidence.
+'''
+
+HOST = "127.0.0.1"
+PORT = 8765
+CACHE_ENTRIES = 256
+
+PNG_SIZE = (960, 716)
+PNG_ZOOM = 12
+MAX_ZOOM = 22
+TOP_DESTINATIONS = 10
+
+
+class ResponseCache():
+    '''
+    Thread-safe LRU cache of encoded responses.
+    '''
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / requests if requests else None, "entries": len(self.entries)}
+
+
+def parse_stations(value):
+    if not value:
+        return None
+    stations = tuple(sorted({int(station) for station in value.split(",") if station.strip()}))
+    if not stations:
+        raise ValueError(f"stations must list at least one station id, got {value!r}")
+    return stations
+
+def parse_hours(value):
+    '''
+    Sorted tuple of hours from e.g. "6-10,14" or "23-4", all hours for an empty value.
+    '''
+    if not value:
+        return tuple(range(HOURS))
+    hours = set()
+    for part in value.split(","):
+        start, _, end = part.partition("-")
+        start, end = int(start), int(end or start)
+        if not (0 <= start < HOURS and 0 <= end < HOURS):
+            raise ValueError(f"hours must be within 0-{HOURS - 1}, got {part}")
+        hours.update(hour_window(start, end))
+    return tuple(sorted(hours))
+
+def feature_collection(geometries, properties):
+    '''
+    GeoJSON of geometries with properties, a dict of column -> values, encoded column by column.
+    '''
+    columns = {name: [json.dumps(value) for value in np.asarray(values).tolist()] for name, values in properties.items()}
+    features = []
+    for i, geometry in enumerate(shapely.to_geojson(geometries)):
+        props = ",".join(f'"{name}":{values[i]}' for name, values in columns.items())
+        features.append(f'{{"type":"Feature","properties":{{{props}}},"geometry":{geometry}}}')
+    return ('{"type":"FeatureCollection","features":[' + ",".join(features) + "]}").encode()
+
+
+class QueryService():
+    def __init__(self, cwd=None):
+        cwd = cwd or os.getcwd()
+        self.processor = DataProcessor(colors=COLORS)
+        self.processor.create_station_points_dict(f"{cwd}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv")
+        self.processor.load_edge_incidence(f"{cwd}/data/processed/edge_incidence", f"{cwd}/data/processed/routes", f"{cwd}/data/processed/graph")
+        self.processor.load_od_tensor(f"{cwd}/data/processed/od_tensor")
+
+        self.od_tensor = self.processor.od_tensor
+        self.incidence = self.processor.incidence
+        self.net_flows = NetFlows.from_od_tensor(self.od_tensor)
+        # built once here, the request threads only read them
+        self.segments = self.incidence.edge_segments(self.processor.graph_store)
+        stations_df = self.processor.stations_df[~self.processor.stations_df.index.duplicated()]
+        self.station_x = stations_df["x"]
+        self.station_y = stations_df["y"]
+
+        self.cache = ResponseCache()
+        # pyplot keeps global state, one png is drawn at a time
+        self.render_lock = threading.Lock()
+
+    def station_points(self, station_ids):
+        '''
+        Station ids that have coordinates and their points.
+        '''
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        station_ids = station_ids[np.isin(station_ids, self.station_x.index)]
+        return station_ids, shapely.points(self.station_x.loc[station_ids].to_numpy(), self.station_y.loc[station_ids].to_numpy())
+
+    def edge_flows(self, stations, hours):
+        if stations is None:
+            raise ValueError("edge_flows needs stations")
+        pairs = self.od_tensor.pair_counts(list(stations), hours)
+        traffic = self.incidence.edge_traffic(self.incidence.route_vector(pairs["pair_key"], pairs["count"]))
+        used = np.flatnonzero(traffic)
+        counts = traffic[used].astype(np.int64)
+        layer = {"column": "log2_count", "cmap": LinearColormap(COLORS, vmin=1, vmax=8), "vmin": 1, "vmax": 8}
+        return self.segments[used], {"count": counts, "log2_count": np.log2(counts + 1)}, layer
+
+    def net_flow(self, stations, hours):
+        window = self.net_flows.window(hours)
+        if stations is not None:
+            window = window[window["Departure station id"].isin(stations)]
+        station_ids, points = self.station_points(window["Departure station id"])
+        window = window.set_index("Departure station id").loc[station_ids]
+        properties = {"station_id": station_ids, **{column: window[column].to_numpy() for column in ["departures", "returns", "volume"]}}
+        properties["net_flow_log2"] = window["net_flow"].to_numpy()
+        limit = max(float(np.abs(properties["net_flow_log2"]).max(initial=0)), 1)
+        layer = {"column": "net_flow_log2", "cmap": "coolwarm", "vmin": -limit, "vmax": limit, "marker_kwds": {"radius": 4}, "style_kwds": {"fillOpacity": 1}}
+        return points, properties, layer
+
+    def top_destinations(self, stations, hours, n):
+        if stations is None:
+            raise ValueError("top_destinations needs stations")
+        top = self.od_tensor.top_destinations(list(stations), hours, n)
+        top = top[top["Return station id"].isin(self.station_x.index)]
+        station_ids, points = self.station_points(top["Return station id"])
+        counts = top["count"].to_numpy()
+        layer = {"column": "log2_count", "cmap": LinearColormap(COLORS, vmin=1, vmax=8), "vmin": 1, "vmax": 8, "marker_kwds": {"radius": 6}, "style_kwds": {"fillOpacity": 1}}
+        return points, {"station_id": station_ids, "count": counts, "log2_count": np.log2(counts + 1)}, layer
+
+    def render_png(self, geometries, properties, layer, stations, zoom, lat, lon):
+        gdf = gpd.GeoDataFrame(properties, geometry=geometries, crs="EPSG:4326")
+        layers = [{"gdf": gdf, **layer}]
+        if stations is not None:
+            _, points = self.station_points(stations)
+            if (lat is None or lon is None) and len(points):
+                lon, lat = float(np.mean(shapely.get_x(points))), float(np.mean(shapely.get_y(points)))
+            layers.append({"gdf": gpd.GeoDataFrame(geometry=points, crs="EPSG:4326"), "color": "#DCBF01", "marker_kwds": {"radius": 4}, "style_kwds": {"fillOpacity": 1}})
+        lat = self.station_y.mean() if lat is None else lat
+        lon = self.station_x.mean() if lon is None else lon
+
+        buffer = io.BytesIO()
+        with self.render_lock:
+            render_static_map(layers, lat, lon, zoom, buffer, tiles="CartoDB dark_matter", size=PNG_SIZE)
+        return buffer.getvalue()
+
+    def query(self, endpoint, params):
+        '''
+        Content type and body of the response, from the cache when the same query was answered before.
+        '''
+        stations = parse_stations(params.get("stations"))
+        hours = parse_hours(params.get("hours"))
+        output = params.get("format", "geojson")
+        if output not in ("geojson", "png"):
+            raise ValueError(f"unknown format {output}")
+        n = int(params.get("n", TOP_DESTINATIONS))
+        zoom = int(params.get("zoom", PNG_ZOOM))
+        lat = float(params["lat"]) if "lat" in params else None
+        lon = float(params["lon"]) if "lon" in params else None
+        if not 0 <= zoom <= MAX_ZOOM:
+            raise ValueError(f"zoom must be within 0-{MAX_ZOOM}, got {zoom}")
+        if lat is not None and not (math.isfinite(lat) and -85 <= lat <= 85):
+            raise ValueError(f"lat must be within -85-85, got {lat}")
+        if lon is not None and not (math.isfinite(lon) and -180 <= lon <= 180):
+            raise ValueError(f"lon must be within -180-180, got {lon}")
+        if stations is not None and not np.isin(stations, self.station_x.index).any():
+            raise LookupError(f"none of the stations {', '.join(map(str, stations))} is known")
+
+        key = (endpoint, stations, hours, output, n if endpoint == "top_destinations" else None) + ((zoom, lat, lon) if output == "png" else ())
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+
+        if endpoint == "edge_flows":
+            geometries, properties, layer = self.edge_flows(stations, hours)
+        elif endpoint == "net_flow":
+            geometries, properties, layer = self.net_flow(stations, hours)
+        else:
+            geometries, properties, layer = self.top_destinations(stations, hours, n)
+
+        if output == "png":
+            response = ("image/png", self.render_png(geometries, properties, layer, stations, zoom, lat, lon))
+        else:
+            response = ("application/geo+json", feature_collection(geometries, properties))
+        self.cache.put(key, response)
+        return response
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    ENDPOINTS = ("edge_flows", "net_flow", "top_destinations")
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        endpoint = url.path.strip("/")
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        if endpoint == "cache":
+            self.respond(200, "application/json", json.dumps(self.server.service.cache.stats()).encode(), start)
+        elif endpoint not in self.ENDPOINTS:
+            self.respond(404, "application/json", json.dumps({"error": f"unknown endpoint, use one of {', '.join(self.ENDPOINTS)}"}).encode(), start)
+        else:
+            try:
+                content_type, body = self.server.service.query(endpoint, params)
+            except ValueError as e:
+                self.respond(400, "application/json", json.dumps({"error": str(e)}).encode(), start)
+                return
+            except LookupError as e:
+                self.respond(404, "application/json", json.dumps({"error": str(e.args[0])}).encode(), start)
+                return
+            except Exception as e:
+                # anything else is a bug, the client still gets an answer and the server keeps running
+                self.log_error("%s failed: %r", self.path, e)
+                self.respond(500, "application/json", json.dumps({"error": f"internal error: {type(e).__name__}"}).encode(), start)
+                return
+            self.respond(200, content_type, body, start)
+
+    def respond(self, status, content_type, body, start):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("X-Query-Ms", f"{(time.perf_counter() - start) * 1000:.1f}")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def query_service_main(host=HOST, port=PORT):
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.service = QueryService()
+    print(f"Serving flow queries on http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves edge flow, net flow and top destination queries over HTTP.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    query_service_main(args.host, args.port)
@@ -0,0 +1,125 @@
+import os
+import time
+import hashlib
+import sqlite3
+
+import numpy as np
+
+'''
+Persistent on-disk cache of routes.
+
+Entries are keyed by a fingerprint of the road graph and the (origin node, destination node) pair
+and store the node sequence of the route. A route found on another graph is never returned.
+Eviction drops entries of other graphs and the least recently used entries above max_entries.
+'''
+
+MAX_ENTRIES = 2_000_000
+
+
+def graph_fingerprint(arrays):
+    sha = hashlib.sha256()
+    for name in ("node_ids", "indptr", "indices", "lengths"):
+        sha.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return sha.hexdigest()[:32]
+
+
+class RouteCache():
+    def __init__(self, path, fingerprint, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS routes (
+                fingerprint TEXT,
+                orig INTEGER,
+                dest INTEGER,
+                nodes BLOB,
+                last_used INTEGER,
+                PRIMARY KEY (fingerprint, orig, dest)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS routes_last_used ON routes (last_used)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_at INTEGER,
+                fingerprint TEXT,
+                hits INTEGER,
+                misses INTEGER
+            )
+        """)
+        self.conn.execute("CREATE TEMP TABLE wanted (orig INTEGER, dest INTEGER)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.execute("INSERT INTO runs VALUES (?, ?, ?, ?)", (int(time.time()), self.fingerprint, self.hits, self.misses))
+        self.conn.commit()
+        self.conn.close()
+
+    def get_many(self, orig, dest):
+        '''
+        Returns a dict of (orig, dest) -> list of node ids (None for a pair known to be unreachable).
+        Pairs that are not in the dict are misses.
+        '''
+        pairs = set(zip(map(int, orig), map(int, dest)))
+
+        self.conn.execute("DELETE FROM wanted")
+        self.conn.executemany("INSERT INTO wanted VALUES (?, ?)", pairs)
+        rows = self.conn.execute("""
+            SELECT r.orig, r.dest, r.nodes FROM wanted w
+            JOIN routes r ON r.fingerprint = ? AND r.orig = w.orig AND r.dest = w.dest
+        """, (self.fingerprint,)).fetchall()
+        self.conn.execute("""
+            UPDATE routes SET last_used = ?
+            WHERE fingerprint = ? AND (orig, dest) IN (SELECT orig, dest FROM wanted)
+        """, (int(time.time()), self.fingerprint))
+
+        found = {(o, d): np.frombuffer(nodes, dtype=np.int64).tolist() if nodes else None for o, d, nodes in rows}
+        self.hits += len(found)
+        self.misses += len(pairs) - len(found)
+        return found
+
+    def put_many(self, orig, dest, routes):
+        now = int(time.time())
+        rows = [
+            (self.fingerprint, int(o), int(d), np.asarray(route, dtype=np.int64).tobytes() if route is not None else b"", now)
+            for o, d, route in zip(orig, dest, routes)
+        ]
+        self.conn.executemany("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def evict(self):
+        # routes of other graphs can not be trusted anymore
+        self.conn.execute("DELETE FROM routes WHERE fingerprint != ?", (self.fingerprint,))
+
+        entries = self.conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+        if entries > self.max_entries:
+            self.conn.execute("""
+                DELETE FROM routes WHERE (fingerprint, orig, dest) IN (
+                    SELECT fingerprint, orig, dest FROM routes ORDER BY last_used LIMIT ?
+                )
+            """, (entries - self.max_entries,))
+        self.conn.commit()
+
+    def compact(self):
+        self.evict()
+        self.conn.execute("VACUUM")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self.conn.execute("SELECT COUNT(*) FROM routes WHERE fingerprint = ?", (self.fingerprint,)).fetchone()[0],
+            "file_mb": os.path.getsize(self.path) / 1e6,
+        }
@@ -0,0 +1,121 @@
+import os
+import json
+
+import numpy as np
+import shapely
+
+from storage import replace_dir
+
+'''
+Routes stored once per undirected station pair as a ragged array.
+
+pair_keys.npy holds the sorted pair keys, offsets.npy the start of each route in nodes.npy
+and nodes.npy the route nodes as indices into the node table of the graph store the routes
+were computed on. Geometries are only built when a consumer asks for them.
+'''
+
+STORE_ARRAYS = ("pair_keys", "offsets", "nodes")
+
+
+def ragged_take(offsets, values, positions):
+    '''
+    Gathers the rows at positions of a ragged array into a new (offsets, values) pair.
+    '''
+    starts = offsets[positions]
+    lengths = offsets[np.asarray(positions) + 1] - starts
+    new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(lengths)
+    index = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return new_offsets, values[index]
+
+
+def save_route_store(store_dir, pair_keys, routes, graph_fingerprint):
+    '''
+    routes are node index arrays of the graph store, in the order of pair_keys.
+    '''
+    pair_keys = np.asarray(pair_keys, dtype=np.int64)
+    lengths = np.fromiter((len(route) for route in routes), dtype=np.int64, count=len(routes))
+    offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    nodes = np.concatenate([np.asarray(route, dtype=np.int32) for route in routes]) if routes else np.empty(0, dtype=np.int32)
+
+    order = np.argsort(pair_keys, kind="stable")
+    offsets, nodes = ragged_take(offsets, nodes, order)
+    write_arrays(store_dir, {"pair_keys": pair_keys[order], "offsets": offsets, "nodes": nodes}, graph_fingerprint)
+
+def write_arrays(store_dir, arrays, graph_fingerprint):
+    # written aside and swapped in, other processes may have the current arrays memory-mapped
+    with replace_dir(store_dir) as tmp_dir:
+        for name in STORE_ARRAYS:
+            np.save(f"{tmp_dir}/{name}.npy", arrays[name])
+        with open(f"{tmp_dir}/meta.json", "w") as f:
+            json.dump({"graph_fingerprint": graph_fingerprint, "routes": len(arrays["pair_keys"])}, f, indent=2)
+
+
+class RouteStore():
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(f"{store_dir}/meta.json") as f:
+            self.meta = json.load(f)
+        for name in STORE_ARRAYS:
+            setattr(self, name, np.load(f"{store_dir}/{name}.npy", mmap_mode="r"))
+        self.graph_fingerprint = self.meta["graph_fingerprint"]
+
+    @classmethod
+    def exists(cls, store_dir):
+        return os.path.exists(f"{store_dir}/meta.json")
+
+    def __len__(self):
+        return len(self.pair_keys)
+
+    def positions(self, pair_keys):
+        '''
+        Positions of pair_keys in the store, -1 where the pair has no route.
+        '''
+        pair_keys = np.asarray(pair_keys, dtype=np.int64)
+        positions = np.searchsorted(self.pair_keys, pair_keys)
+        positions = np.minimum(positions, max(len(self) - 1, 0))
+        found = (len(self) > 0) & (np.asarray(self.pair_keys)[positions] == pair_keys) if len(self) else np.zeros(len(pair_keys), dtype=bool)
+        return np.where(found, positions, -1)
+
+    def route(self, pair_key):
+        position = self.positions([pair_key])[0]
+        if position < 0:
+            return None
+        return np.asarray(self.nodes[self.offsets[position]:self.offsets[position + 1]])
+
+    def append(self, pair_keys, routes):
+        '''
+        Adds new routes and rewrites the store. Keys already in the store are replaced.
+        '''
+        keep = np.flatnonzero(~np.isin(self.pair_keys, pair_keys))
+        offsets, nodes = ragged_take(np.asarray(self.offsets), np.asarray(self.nodes), keep)
+        old_routes = [nodes[offsets[i]:offsets[i + 1]] for i in range(len(keep))]
+
+        all_keys = np.concatenate([np.asarray(self.pair_keys)[keep], np.asarray(pair_keys, dtype=np.int64)])
+        save_route_store(self.store_dir, all_keys, old_routes + list(routes), self.graph_fingerprint)
+        self.__init__(self.store_dir)
+
+    def geometries(self, graph_store, pair_keys=None, decimals=None):
+        '''
+        LineStrings (EPSG:4326) of the given pairs, all pairs by default, built with one vectorized call.
+        Returns the pair keys and an array of geometries, None where a route has a single node.
+        '''
+        pair_keys = np.asarray(self.pair_keys if pair_keys is None else pair_keys, dtype=np.int64)
+        positions = self.positions(pair_keys)
+        pair_keys, positions = pair_keys[positions >= 0], positions[positions >= 0]
+
+        offsets, nodes = ragged_take(np.asarray(self.offsets), np.asarray(self.nodes), positions)
+        lengths = np.diff(offsets)
+        coords = np.column_stack([np.asarray(graph_store.x)[nodes], np.asarray(graph_store.y)[nodes]])
+        if decimals is not None:
+            coords = np.round(coords, decimals)
+
+        geometries = np.full(len(pair_keys), None, dtype=object)
+        is_line = lengths > 1
+        line_rows = np.repeat(is_line, lengths)
+        if is_line.any():
+            line_index = np.repeat(np.arange(is_line.sum()), lengths[is_line])
+            geometries[is_line] = shapely.linestrings(coords[line_rows], indices=line_index)
+
+        return pair_keys, geometries
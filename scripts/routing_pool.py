@@ -0,0 +1,314 @@
+import os
+import time
+import heapq
+import resource
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+
+'''
+Routing worker pool that shares the road graph instead of pickling it into every task.
+
+The graph is exported once into CSR arrays (indptr, indices, edge lengths) placed in shared memory.
+Workers attach to the arrays in their initializer without copying them and each task
+carries only its slice of (origin, destination) node indices.
+
+Two engines run on the pool: point-to-point Dijkstra per pair (route_pairs), and one
+single-source Dijkstra per distinct origin whose predecessor tree gives the paths to all
+of that origin's destinations (route_pairs_by_origin).
+'''
+
+GRAPH_ARRAYS = ("node_ids", "x", "y", "indptr", "indices", "lengths")
+
+
+def graph_to_csr(G):
+    '''
+    Exports a NetworkX graph to CSR arrays with nodes sorted by id. Parallel edges keep
+    the shortest length, the same edge ox.shortest_path would use.
+    '''
+    node_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    x = np.array([data["x"] for _, data in G.nodes(data=True)], dtype=np.float64)
+    y = np.array([data["y"] for _, data in G.nodes(data=True)], dtype=np.float64)
+
+    order = np.argsort(node_ids)
+    node_ids, x, y = node_ids[order], x[order], y[order]
+    node_index = pd.Series(np.arange(len(node_ids)), index=node_ids)
+
+    edges = pd.DataFrame(list(G.edges(data="length")), columns=["u", "v", "length"])
+    edges["u"] = node_index[edges["u"].to_numpy()].to_numpy()
+    edges["v"] = node_index[edges["v"].to_numpy()].to_numpy()
+    edges = edges.sort_values(["u", "v", "length"]).drop_duplicates(["u", "v"])
+
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(edges["u"].to_numpy(), minlength=len(node_ids)))
+
+    return {
+        "node_ids": node_ids,
+        "x": x,
+        "y": y,
+        "indptr": indptr,
+        "indices": edges["v"].to_numpy().astype(np.int64),
+        "lengths": edges["length"].to_numpy().astype(np.float64),
+    }
+
+
+class SharedGraph():
+    '''
+    Owns the shared memory blocks of the CSR arrays. spec is small and picklable,
+    workers pass it to attach_graph to get the arrays back.
+    '''
+    def __init__(self, arrays):
+        self.blocks = []
+        self.spec = {}
+        for name in GRAPH_ARRAYS:
+            array = np.ascontiguousarray(arrays[name])
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            self.blocks.append(block)
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_graph(spec):
+    blocks = []
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return arrays, blocks
+
+
+def dijkstra_path(indptr, indices, lengths, source, target):
+    '''
+    Point-to-point Dijkstra with early exit. Arguments are memoryviews so that
+    indexing returns plain Python numbers. Returns the node indices of the path or None.
+    '''
+    if source == target:
+        return [source]
+
+    dist = {source: 0.0}
+    pred = {source: -1}
+    done = set()
+    heap = [(0.0, source)]
+
+    while heap:
+        d, u = heapq.heappop(heap)
+        if u in done:
+            continue
+        if u == target:
+            path = [u]
+            while pred[u] != -1:
+                u = pred[u]
+                path.append(u)
+            return path[::-1]
+        done.add(u)
+
+        for i in range(indptr[u], indptr[u + 1]):
+            v = indices[i]
+            nd = d + lengths[i]
+            if nd < dist.get(v, float("inf")):
+                dist[v] = nd
+                pred[v] = u
+                heapq.heappush(heap, (nd, v))
+
+    return None
+
+
+# set in each worker by init_worker
+_graph = None
+_blocks = None
+
+def init_worker(spec):
+    global _graph, _blocks
+    arrays, _blocks = attach_graph(spec)
+    # memoryviews over the shared buffers: zero-copy and fast scalar indexing
+    _graph = {name: memoryview(arrays[name]) for name in ("indptr", "indices", "lengths")}
+
+def route_chunk(args):
+    start, orig, dest = args
+    started = time.perf_counter()
+
+    routes = [dijkstra_path(_graph["indptr"], _graph["indices"], _graph["lengths"], o, d) for o, d in zip(orig.tolist(), dest.tolist())]
+
+    timing = {
+        "pid": os.getpid(),
+        "start": start,
+        "pairs": len(routes),
+        "seconds": time.perf_counter() - started,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    return start, routes, timing
+
+
+def route_pairs(shared_graph, orig, dest, processes, chunk_size=4000):
+    '''
+    Routes orig[i] -> dest[i] (node indices into the CSR arrays) in a pool attached to shared_graph.
+    Returns the routes as lists of node indices (None when unreachable) and the per-chunk timings.
+    '''
+    orig = np.asarray(orig, dtype=np.int64)
+    dest = np.asarray(dest, dtype=np.int64)
+    tasks = [(i, orig[i:i+chunk_size], dest[i:i+chunk_size]) for i in range(0, len(orig), chunk_size)]
+
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(shared_graph.spec,)) as pool:
+        results = sorted(pool.imap_unordered(route_chunk, tasks), key=lambda result: result[0])
+
+    routes = [route for _, chunk_routes, _ in results for route in chunk_routes]
+    timings = [timing for _, _, timing in results]
+    return routes, timings
+
+
+def predecessor_path(predecessors, source, target):
+    '''
+    Walks a scipy predecessor row back from target. Returns None when target was not reached.
+    '''
+    if source == target:
+        return [source]
+    if predecessors[target] < 0:
+        return None
+
+    path = [target]
+    while target != source:
+        target = predecessors[target]
+        path.append(target)
+    return path[::-1]
+
+
+_csgraph = None
+
+def init_origin_worker(spec):
+    global _csgraph, _blocks
+    arrays, _blocks = attach_graph(spec)
+    n = len(arrays["indptr"]) - 1
+    _csgraph = sp.csr_matrix((arrays["lengths"], arrays["indices"], arrays["indptr"]), shape=(n, n))
+
+def route_origin_chunk(args):
+    start, origins, targets = args
+    started = time.perf_counter()
+
+    _, predecessors = dijkstra(_csgraph, directed=True, indices=origins, return_predecessors=True)
+    routes = [
+        [predecessor_path(memoryview(predecessors[i]), origin, target) for target in origin_targets.tolist()]
+        for i, (origin, origin_targets) in enumerate(zip(origins.tolist(), targets))
+    ]
+
+    timing = {
+        "pid": os.getpid(),
+        "start": start,
+        "pairs": sum(len(origin_targets) for origin_targets in targets),
+        "seconds": time.perf_counter() - started,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    return start, routes, timing
+
+
+def route_pairs_by_origin(shared_graph, orig, dest, processes, origins_per_task=32):
+    '''
+    Same contract as route_pairs, but runs one single-source search per distinct origin node.
+    '''
+    orig = np.asarray(orig, dtype=np.int64)
+    dest = np.asarray(dest, dtype=np.int64)
+
+    order = np.argsort(orig, kind="stable")
+    origins, first, counts = np.unique(orig[order], return_index=True, return_counts=True)
+    targets = np.split(dest[order], first[1:])
+
+    tasks = [(i, origins[i:i+origins_per_task], targets[i:i+origins_per_task]) for i in range(0, len(origins), origins_per_task)]
+
+    with multiprocessing.Pool(processes, initializer=init_origin_worker, initargs=(shared_graph.spec,)) as pool:
+        results = sorted(pool.imap_unordered(route_origin_chunk, tasks), key=lambda result: result[0])
+
+    sorted_routes = [route for _, chunk_routes, _ in results for origin_routes in chunk_routes for route in origin_routes]
+    routes = [None] * len(orig)
+    for position, route in zip(order, sorted_routes):
+        routes[position] = route
+
+    timings = [timing for _, _, timing in results]
+    return routes, timings
+
+
+def worker_report(timings):
+    df = pd.DataFrame(timings)
+    return df.groupby("pid").agg(chunks=("start", "count"), pairs=("pairs", "sum"), seconds=("seconds", "sum"), max_rss_mb=("max_rss_mb", "max")).reset_index()
+
+def benchmark_routing_pool(G, orig_nodes, dest_nodes, cores=(1, 2, 4, 8), chunk_size=4000):
+    '''
+    Routes the same node pairs with increasing worker counts and reports
+    end-to-end time, speedup over one worker and per-worker peak memory.
+    '''
+    arrays = graph_to_csr(G)
+    node_index = pd.Series(np.arange(len(arrays["node_ids"])), index=arrays["node_ids"])
+    orig = node_index[np.asarray(orig_nodes)].to_numpy()
+    dest = node_index[np.asarray(dest_nodes)].to_numpy()
+
+    rows = []
+    with SharedGraph(arrays) as shared_graph:
+        for processes in cores:
+            started = time.perf_counter()
+            _, timings = route_pairs(shared_graph, orig, dest, processes, chunk_size)
+            workers = worker_report(timings)
+            rows.append({
+                "processes": processes,
+                "seconds": time.perf_counter() - started,
+                "worker_max_rss_mb": workers["max_rss_mb"].max(),
+                "worker_mean_rss_mb": workers["max_rss_mb"].mean(),
+            })
+
+    report = pd.DataFrame(rows)
+    report["speedup"] = report["seconds"].iloc[0] / report["seconds"]
+    print(report.to_string(index=False))
+    return report
+
+
+def path_length(arrays, path):
+    indptr, indices, lengths = arrays["indptr"], arrays["indices"], arrays["lengths"]
+    total = 0.0
+    for u, v in zip(path[:-1], path[1:]):
+        row = slice(indptr[u], indptr[u + 1])
+        total += lengths[row][indices[row] == v][0]
+    return total
+
+def benchmark_origin_grouping(arrays, orig, dest, processes=1, chunk_size=4000):
+    '''
+    Routes the same pairs (node indices) per pair and grouped by origin, and checks that
+    both engines return paths of the same length (equal-length ties may pick different streets).
+    '''
+    with SharedGraph(arrays) as shared_graph:
+        started = time.perf_counter()
+        per_pair, _ = route_pairs(shared_graph, orig, dest, processes, chunk_size)
+        per_pair_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        by_origin, _ = route_pairs_by_origin(shared_graph, orig, dest, processes)
+        by_origin_seconds = time.perf_counter() - started
+
+    mismatches = sum(
+        (a is None) != (b is None) or (a is not None and not np.isclose(path_length(arrays, a), path_length(arrays, b)))
+        for a, b in zip(per_pair, by_origin)
+    )
+    report = {
+        "pairs": len(orig),
+        "origins": len(np.unique(orig)),
+        "per_pair_seconds": per_pair_seconds,
+        "by_origin_seconds": by_origin_seconds,
+        "speedup": per_pair_seconds / by_origin_seconds,
+        "identical_paths": sum(a == b for a, b in zip(per_pair, by_origin)),
+        "length_mismatches": mismatches,
+    }
+    print(report)
+    return report
@@ -0,0 +1,113 @@
+import numpy as np
+
+import storage
+from aggregate_trips import MEMORY_BUDGET_MB, BYTES_PER_KEY, batch_rows, iter_trip_batches
+from time_bins import HOURS, EPOCH_WEEKDAY
+from instrumentation import measure
+
+'''
+Departures and returns per (station, day, hour) as dense int32 arrays.
+
+Every batch of trips is reduced to packed (station, day, hour) keys with their counts, the
+partials are merged whenever they grow past the memory budget and finally spread into
+(n_stations x n_days x 24) arrays covering every day from the first to the last trip. Like the net flows, returns are counted at the
+departure hour of the trip. The arrays are the input of the station-day and station-weekday
+profile clustering.
+'''
+
+# room for the day number in the packed keys, days since 1970
+DAY_SLOTS = 1 << 17
+
+
+def pack_station_day_keys(station_ids, days, hours):
+    return (station_ids.astype(np.int64) * DAY_SLOTS + days) * HOURS + hours
+
+def count_keys(keys):
+    return np.unique(keys, return_counts=True)
+
+def merge_counts(partials):
+    keys = np.concatenate([keys for keys, _ in partials])
+    counts = np.concatenate([counts for _, counts in partials])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+
+
+class StationDays():
+    def __init__(self, station_ids, first_day, departures, returns):
+        # departures and returns are (n_stations x n_days x 24) arrays, day 0 is first_day
+        self.station_ids = station_ids
+        self.first_day = first_day
+        self.departures = departures
+        self.returns = returns
+
+    @classmethod
+    def from_counts(cls, dep_keys, dep_counts, ret_keys, ret_counts):
+        rest, hours = np.divmod(np.concatenate([dep_keys, ret_keys]), HOURS)
+        stations, days = np.divmod(rest, DAY_SLOTS)
+        station_ids = np.unique(stations)
+        first_day = int(days.min())
+        n_days = int(days.max()) - first_day + 1
+        cells = (np.searchsorted(station_ids, stations) * n_days + days - first_day) * HOURS + hours
+        shape = (len(station_ids), n_days, HOURS)
+
+        def dense(rows, counts):
+            return np.bincount(cells[rows], weights=counts, minlength=np.prod(shape)).astype(np.int32).reshape(shape)
+
+        n_dep = len(dep_keys)
+        return cls(station_ids, np.datetime64(first_day, "D"), dense(slice(None, n_dep), dep_counts), dense(slice(n_dep, None), ret_counts))
+
+    @classmethod
+    def load(cls, save_dir=None):
+        save_dir = save_dir or default_dir()
+        first_day = np.load(f"{save_dir}/first_day.npy")[()]
+        return cls(np.load(f"{save_dir}/station_ids.npy"), first_day, np.load(f"{save_dir}/departures.npy", mmap_mode="r"), np.load(f"{save_dir}/returns.npy", mmap_mode="r"))
+
+    def save(self, save_dir=None):
+        save_dir = save_dir or default_dir()
+        with storage.replace_dir(save_dir) as tmp_dir:
+            np.save(f"{tmp_dir}/station_ids.npy", self.station_ids)
+            np.save(f"{tmp_dir}/first_day.npy", np.datetime64(self.first_day, "D"))
+            np.save(f"{tmp_dir}/departures.npy", self.departures)
+            np.save(f"{tmp_dir}/returns.npy", self.returns)
+
+    @property
+    def days(self):
+        return self.first_day + np.arange(self.departures.shape[1])
+
+    @property
+    def weekdays(self):
+        # 0 is Monday
+        return (self.days.astype(np.int64) + EPOCH_WEEKDAY) % 7
+
+
+def default_dir():
+    return f"{storage.processed_dir()}/station_days"
+
+def aggregate_station_days(partition_paths, memory_budget_mb=MEMORY_BUDGET_MB):
+    merge_threshold = memory_budget_mb * 1_000_000 // 2 // BYTES_PER_KEY
+    dep_partials, ret_partials = [], []
+
+    with measure("aggregate_station_days", partitions=len(partition_paths)) as record:
+        trips = 0
+        for dep_ids, ret_ids, bins in iter_trip_batches(partition_paths, batch_rows(memory_budget_mb), bins=("day", "hour")):
+            days, hours = bins["day"].astype(np.int64), bins["hour"].astype(np.int64)
+            dep_partials.append(count_keys(pack_station_day_keys(dep_ids, days, hours)))
+            ret_partials.append(count_keys(pack_station_day_keys(ret_ids, days, hours)))
+            trips += len(dep_ids)
+
+            if sum(len(keys) for keys, _ in dep_partials + ret_partials) > merge_threshold:
+                dep_partials = [merge_counts(dep_partials)]
+                ret_partials = [merge_counts(ret_partials)]
+
+        station_days = StationDays.from_counts(*merge_counts(dep_partials), *merge_counts(ret_partials))
+        record["rows_in"] = trips
+        record["rows_out"] = int(np.prod(station_days.departures.shape))
+
+    return station_days
+
+
+def station_days_main(memory_budget_mb=MEMORY_BUDGET_MB):
+    aggregate_station_days(storage.trip_partitions(), memory_budget_mb).save()
+
+if __name__ == "__main__":
+    station_days_main()
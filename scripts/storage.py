@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+'''
+Shared storage layer for the processed tables.
+Every table is a parquet file in data/processed with an explicit schema, so readers get
+compact dtypes back without re-parsing text and can ask for only the columns and rows they need.
+
+Trips are stored as a directory of partitions (data/processed/trips/*.parquet), the other
+tables as single files (data/processed/<name>.parquet).
+'''
+
+STATION_NAME = pa.dictionary(pa.int32(), pa.string())
+
+TRIP_SCHEMA = pa.schema([
+    ("Departure", pa.timestamp("s")),
+    ("Return", pa.timestamp("s")),
+    ("Departure station id", pa.int16()),
+    ("Departure station name", STATION_NAME),
+    ("Return station id", pa.int16()),
+    ("Return station name", STATION_NAME),
+    ("Covered distance (m)", pa.float32()),
+    ("Duration (sec.)", pa.float32()),
+    # time bins of the departure, see time_bins.py
+    ("quarter_hour", pa.int8()),
+    ("hour", pa.int8()),
+    ("hour_of_week", pa.int16()),
+    ("weekday", pa.int8()),
+    ("weekend", pa.int8()),
+    ("month", pa.int8()),
+    ("day", pa.int16()),
+])
+
+SCHEMAS = {
+    "station_pair_counts": pa.schema([
+        ("Departure station id", pa.int16()),
+        ("Return station id", pa.int16()),
+        ("count", pa.int32()),
+        ("x_dep", pa.float64()),
+        ("y_dep", pa.float64()),
+        ("x_ret", pa.float64()),
+        ("y_ret", pa.float64()),
+    ]),
+    "grouped_counts": pa.schema([
+        ("Departure station id", pa.int16()),
+        ("Return station id", pa.int16()),
+        ("hour", pa.int8()),
+        ("count", pa.int32()),
+        ("pair_key", pa.int64()),
+    ]),
+    "net_flows": pa.schema([
+        ("Departure station id", pa.int16()),
+        ("hour", pa.int8()),
+        ("departures", pa.int32()),
+        ("returns", pa.int32()),
+        ("volume", pa.int32()),
+        ("net_flow", pa.float32()),
+        ("lon", pa.float64()),
+        ("lat", pa.float64()),
+    ]),
+}
+
+# sorting by the leading columns keeps the row group statistics tight for predicate pushdown
+SORT_KEYS = {
+    "station_pair_counts": ["Departure station id", "Return station id"],
+    "grouped_counts": ["Departure station id", "Return station id", "hour"],
+    "net_flows": ["Departure station id", "hour"],
+}
+
+ROW_GROUP_SIZE = 256_000
+
+
+def processed_dir():
+    return f"{os.getcwd()}/data/processed"
+
+def table_path(name):
+    return f"{processed_dir()}/{name}.parquet"
+
+def trips_dir():
+    return f"{processed_dir()}/trips"
+
+
+def to_arrow(df, schema):
+    return pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+
+def write_table(df, name):
+    schema = SCHEMAS[name]
+    df = df.sort_values(SORT_KEYS[name])
+    path = table_path(name)
+    tmp_path = f"{path}.part"
+
+    pq.write_table(to_arrow(df, schema), tmp_path, row_group_size=ROW_GROUP_SIZE)
+    os.replace(tmp_path, path)
+
+@contextmanager
+def replace_dir(path):
+    '''
+    Yields a temporary directory next to path that is swapped in for path when the block ends.
+    Readers that have the old files memory-mapped keep them until they close them, and a block
+    that fails leaves path as it was.
+    '''
+    parent, name = os.path.split(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{name}.", dir=parent)
+    os.chmod(tmp_dir, 0o755)
+    try:
+        yield tmp_dir
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    old_dir = f"{tmp_dir}.old"
+    if os.path.exists(path):
+        os.replace(path, old_dir)
+    os.replace(tmp_dir, path)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+def read_table(name, columns=None, filters=None):
+    '''
+    Reads a processed table. Only the given columns are decoded and
+    filters (pyarrow DNF, e.g. [("hour", "in", [6, 7, 8])]) are pushed down to the row groups.
+    '''
+    return pq.read_table(table_path(name), columns=columns, filters=filters).to_pandas()
+
+def read_trips(columns=None, filters=None, path=None):
+    return pq.read_table(path or trips_dir(), columns=columns, filters=filters).to_pandas()
+
+def trip_partitions(path=None):
+    path = path or trips_dir()
+    return sorted(f"{path}/{name}" for name in os.listdir(path) if name.endswith(".parquet"))
+
+def partition_rows(path):
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def manifest_path():
+    return f"{processed_dir()}/manifest.json"
+
+def read_manifest():
+    '''
+    The manifest records which trip partitions are folded into the aggregates, the partitions
+    of an update that is still folding them in and the input digests each downstream stage was
+    last built from.
+    '''
+    if not os.path.exists(manifest_path()):
+        return {"partitions": {}, "pending": {}, "stage_inputs": {}}
+    with open(manifest_path()) as f:
+        return json.load(f)
+
+def write_manifest(manifest):
+    tmp_path = f"{manifest_path()}.part"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path())
+
+
+def timed(func, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def compare_with_csv(name, csv_path=None, columns=None):
+    '''
+    Compares load time and file size of a parquet table with the csv it replaces.
+    If the old csv is not around, the table is written out as csv for the comparison.
+    '''
+    parquet_path = table_path(name)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if csv_path is None or not os.path.exists(csv_path):
+            csv_path = f"{tmp_dir}/{name}.csv"
+            read_table(name).to_csv(csv_path, index=False)
+
+        return {
+            "table": name,
+            "csv_mb": os.path.getsize(csv_path) / 1e6,
+            "parquet_mb": os.path.getsize(parquet_path) / 1e6,
+            "csv_load_s": timed(lambda: pd.read_csv(csv_path, usecols=columns)),
+            "parquet_load_s": timed(lambda: read_table(name, columns=columns)),
+        }
+
+def storage_report():
+    rows = []
+    for name in SCHEMAS:
+        if os.path.exists(table_path(name)):
+            rows.append(compare_with_csv(name, f"{processed_dir()}/{name}.csv"))
+
+    # the projected read used by the trips per hour chart
+    if os.path.exists(table_path("grouped_counts")):
+        row = compare_with_csv("grouped_counts", columns=["hour", "count"])
+        row["table"] = "grouped_counts[hour, count]"
+        rows.append(row)
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    return report
+
+if __name__ == "__main__":
+    storage_report()
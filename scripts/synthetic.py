@@ -0,0 +1,231 @@
+import os
+import glob
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import networkx as nx
+
+from storage import TRIP_SCHEMA
+from time_bins import add_time_bins
+from graph_store import save_graph_store
+
+'''
+Synthetic trips and road graph for benchmarks and offline runs.
+
+Trips use the real stations of the station csv and the schema of the HSL od-trips data.
+Volume per month follows the riding season, departure hours follow a weekday commute profile
+(peaks at 8 and 16-17) or a weekend afternoon profile. In the weekday peaks departures are
+drawn towards outer stations in the morning and central stations in the afternoon, returns
+towards the opposite end, and every return station is weighted down with its distance from
+the departure station. Trips are written straight into monthly trip partitions, in chunks,
+so 100M trips do not have to fit in memory.
+
+The road graph is a regular grid over the station area with noisy edge lengths.
+
+python scripts/synthetic.py <workspace> writes a workspace of its own, like the benchmark ones,
+with a copy of data/raw, the synthetic partitions and the grid graph. It refuses a workspace
+that already holds trip partitions or a graph store, so the real data/processed is never
+overwritten.
+'''
+
+SCALES = {"1M": 1_000_000, "10M": 10_000_000, "100M": 100_000_000}
+
+# Rautatientori
+CENTER = (24.941, 60.171)
+
+# share of the year's trips in each month, nothing in the winter months
+MONTH_WEIGHTS = {4: 0.06, 5: 0.14, 6: 0.17, 7: 0.17, 8: 0.17, 9: 0.15, 10: 0.11, 11: 0.03}
+
+WEEKDAY_HOURS = np.array([1, 0.5, 0.3, 0.2, 0.3, 1, 3, 7, 9, 5, 3.5, 3.5, 4, 4, 4.5, 6.5, 8.5, 8, 6, 4.5, 3.5, 3, 2.5, 1.8])
+WEEKEND_HOURS = np.array([2.5, 2, 1.5, 0.8, 0.4, 0.4, 0.6, 1, 2, 3.5, 5, 6, 6.5, 7, 7, 6.5, 6, 5.5, 4.5, 4, 3.5, 3, 3, 2.8])
+
+MORNING_PEAK = range(6, 10)
+AFTERNOON_PEAK = range(15, 19)
+
+# mean trip length and the distance decay of the return station choice
+DISTANCE_DECAY_M = 1500
+DETOUR_FACTOR = 1.3
+SPEED_M_S = 4.2
+
+ROWS_PER_CHUNK = 1_000_000
+
+
+def haversine_m(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * 6371000 * np.arcsin(np.sqrt(a))
+
+
+class TripGenerator():
+    def __init__(self, stations_df, year=2024, seed=0):
+        self.stations_df = stations_df.drop_duplicates("ID").reset_index(drop=True)
+        self.year = year
+        self.rng = np.random.default_rng(seed)
+
+        x, y = self.stations_df["x"].to_numpy(), self.stations_df["y"].to_numpy()
+        self.distances = haversine_m(x[:, None], y[:, None], x[None, :], y[None, :])
+
+        # busy stations have more capacity, central ones attract commuters in the morning
+        popularity = self.stations_df["Kapasiteet"].fillna(10).clip(lower=5).to_numpy(dtype=np.float64)
+        centrality = np.exp(-haversine_m(x, y, *CENTER) / 3000)
+        decay = np.exp(-self.distances / DISTANCE_DECAY_M)
+
+        # departure weights and return probabilities for off-peak, morning and afternoon trips
+        self.departure_weights = [popularity, popularity * (1 - centrality + 0.1), popularity * (centrality + 0.1)]
+        self.return_probabilities = [self.normalize(decay * weights[None, :]) for weights in (popularity, popularity * (centrality + 0.1), popularity * (1 - centrality + 0.1))]
+
+    @staticmethod
+    def normalize(matrix):
+        return matrix / matrix.sum(axis=1, keepdims=True)
+
+    def departures(self, month, trips):
+        '''
+        Departure times of the month: days uniform, hours from the weekday or weekend profile.
+        '''
+        start = pd.Timestamp(year=self.year, month=month, day=1)
+        days = pd.date_range(start, start + pd.offsets.MonthEnd(0), freq="D")
+        weekend = days.dayofweek.to_numpy() >= 5
+
+        day = self.rng.integers(0, len(days), trips)
+        hour = np.empty(trips, dtype=np.int64)
+        for is_weekend, profile in ((False, WEEKDAY_HOURS), (True, WEEKEND_HOURS)):
+            rows = weekend[day] == is_weekend
+            hour[rows] = self.rng.choice(24, size=rows.sum(), p=profile / profile.sum())
+
+        seconds = hour * 3600 + self.rng.integers(0, 3600, trips)
+        return days.to_numpy()[day] + seconds.astype("timedelta64[s]"), hour, weekend[day]
+
+    def chunk(self, month, trips):
+        departure, hour, weekend = self.departures(month, trips)
+
+        # 0 off-peak, 1 morning peak, 2 afternoon peak, the peaks only on weekdays
+        period = np.zeros(trips, dtype=np.int64)
+        period[~weekend & np.isin(hour, MORNING_PEAK)] = 1
+        period[~weekend & np.isin(hour, AFTERNOON_PEAK)] = 2
+
+        n_stations = len(self.stations_df)
+        dep = np.empty(trips, dtype=np.int64)
+        ret = np.empty(trips, dtype=np.int64)
+        for p in range(3):
+            rows = np.flatnonzero(period == p)
+            weights = self.departure_weights[p]
+            dep[rows] = self.rng.choice(n_stations, size=len(rows), p=weights / weights.sum())
+
+            # returns drawn per departure station from its row of return probabilities
+            order = rows[np.argsort(dep[rows], kind="stable")]
+            stations, starts = np.unique(dep[order], return_index=True)
+            for station, group in zip(stations, np.split(order, starts[1:])):
+                ret[group] = self.rng.choice(n_stations, size=len(group), p=self.return_probabilities[p][station])
+
+        distance = self.distances[dep, ret] * DETOUR_FACTOR * self.rng.lognormal(0, 0.2, trips) + 50
+        duration = distance / SPEED_M_S * self.rng.lognormal(0, 0.3, trips) + 30
+
+        ids = self.stations_df["ID"].to_numpy()
+        names = self.stations_df["Nimi"].astype(str).to_numpy()
+        df = pd.DataFrame({
+            "Departure": departure,
+            "Return": departure + np.round(duration).astype("timedelta64[s]"),
+            "Departure station id": ids[dep],
+            "Departure station name": names[dep],
+            "Return station id": ids[ret],
+            "Return station name": names[ret],
+            "Covered distance (m)": distance.astype(np.float32),
+            "Duration (sec.)": np.round(duration).astype(np.float32),
+        })
+        return pa.Table.from_pandas(add_time_bins(df.sort_values("Departure")), schema=TRIP_SCHEMA, preserve_index=False, safe=False)
+
+    def month_volumes(self, trips):
+        months = np.array(list(MONTH_WEIGHTS))
+        weights = np.array(list(MONTH_WEIGHTS.values()))
+        return dict(zip(months.tolist(), self.rng.multinomial(trips, weights / weights.sum()).tolist()))
+
+
+def write_synthetic_partitions(stations_path, partitions_dir, trips, year=2024, seed=0, rows_per_chunk=ROWS_PER_CHUNK):
+    '''
+    Writes trips synthetic trips as monthly partitions named like the HSL months (e.g. 2024-05).
+    Returns a dict of partition name -> row count.
+    '''
+    os.makedirs(partitions_dir, exist_ok=True)
+    generator = TripGenerator(pd.read_csv(stations_path), year, seed)
+    written = {}
+
+    for month, month_trips in generator.month_volumes(trips).items():
+        name = f"{year}-{month:02d}"
+        partition_path = f"{partitions_dir}/{name}.parquet"
+        tmp_path = f"{partition_path}.part"
+
+        with pq.ParquetWriter(tmp_path, TRIP_SCHEMA) as writer:
+            for start in range(0, month_trips, rows_per_chunk):
+                writer.write_table(generator.chunk(month, min(rows_per_chunk, month_trips - start)), row_group_size=rows_per_chunk)
+
+        os.replace(tmp_path, partition_path)
+        written[name] = month_trips
+
+    return written
+
+
+def synthetic_graph(stations_df, spacing_m=250, margin_m=1000, seed=0):
+    '''
+    Grid road graph covering the stations, two-way edges between neighbouring grid nodes
+    with lengths of 1-1.3 times the straight distance.
+    '''
+    rng = np.random.default_rng(seed)
+    lat0 = np.radians(stations_df["y"].mean())
+    dy = spacing_m / 111_320
+    dx = dy / np.cos(lat0)
+    margin_y = margin_m / 111_320
+    margin_x = margin_y / np.cos(lat0)
+
+    xs = np.arange(stations_df["x"].min() - margin_x, stations_df["x"].max() + margin_x, dx)
+    ys = np.arange(stations_df["y"].min() - margin_y, stations_df["y"].max() + margin_y, dy)
+    n_cols = len(xs)
+
+    G = nx.MultiDiGraph(crs="EPSG:4326")
+    for i, y in enumerate(ys):
+        for j, x in enumerate(xs):
+            G.add_node(i * n_cols + j, x=float(x), y=float(y))
+
+    for i in range(len(ys)):
+        for j in range(n_cols):
+            u = i * n_cols + j
+            neighbours = ([u + 1] if j < n_cols - 1 else []) + ([u + n_cols] if i < len(ys) - 1 else [])
+            for v in neighbours:
+                length = float(spacing_m * rng.uniform(1, 1.3))
+                G.add_edge(u, v, length=length)
+                G.add_edge(v, u, length=length)
+    return G
+
+def build_synthetic_graph_store(stations_path, store_dir, spacing_m=250, seed=0):
+    G = synthetic_graph(pd.read_csv(stations_path), spacing_m=spacing_m, seed=seed)
+    save_graph_store(G, store_dir, source=f"synthetic grid {spacing_m} m")
+
+
+def synthetic_main(workspace, trips="1M", seed=0):
+    cwd = os.getcwd()
+    workspace = os.path.abspath(workspace)
+    partitions_dir = f"{workspace}/data/processed/trips"
+    graph_path = f"{workspace}/data/processed/graph"
+
+    if glob.glob(f"{partitions_dir}/*.parquet") or os.path.exists(graph_path):
+        raise FileExistsError(f"{workspace} already holds trip partitions or a graph store, use an empty workspace")
+
+    if workspace != cwd:
+        shutil.copytree(f"{cwd}/data/raw", f"{workspace}/data/raw", dirs_exist_ok=True)
+    os.makedirs(f"{workspace}/presentation", exist_ok=True)
+    stations_path = f"{workspace}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
+
+    write_synthetic_partitions(stations_path, partitions_dir, SCALES.get(trips, trips), seed=seed)
+    build_synthetic_graph_store(stations_path, graph_path, seed=seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes synthetic trips and a grid road graph into a separate workspace.")
+    parser.add_argument("workspace", help="directory to write, must not hold trip partitions or a graph store yet")
+    parser.add_argument("--trips", default="1M", help=f"number of trips or one of {', '.join(SCALES)}")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    synthetic_main(args.workspace, int(args.trips) if args.trips.isdigit() else args.trips, args.seed)
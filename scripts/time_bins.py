@@ -0,0 +1,102 @@
+import numpy as np
+
+'''
+Integer time bins of the trip departures.
+
+Every trip gets a code at each resolution, computed with integer arithmetic on the departure
+time (ms since 1970 in the local time of the HSL data) when the trips are ingested and stored
+as small int columns of the trip partitions:
+
+quarter_hour  0-95   15 minute slot of the day
+hour          0-23   hour of day after rounding to the nearest hour, ties to even
+hour_of_week  0-167  Monday 0:00 is 0
+weekday       0-6    Monday is 0
+weekend       0-1
+month         1-12
+day                  days since 1970
+
+The quarter hour and the month are of the departure itself, so the month always matches the
+monthly partition of the trip. The other bins are of the rounded departure, so a departure at
+23:50 on Sunday is hour 0 of Monday in every one of them. A time window is a set of codes, bin_window gives a range
+that may wrap around and window_mask turns codes into a boolean mask with a lookup table.
+'''
+
+MS_PER_MINUTE = 60_000
+MS_PER_HOUR = 60 * MS_PER_MINUTE
+MS_PER_DAY = 24 * MS_PER_HOUR
+HOURS = 24
+
+# name -> (size of a lookup table over the codes, dtype), the day has no fixed size
+BINS = {
+    "quarter_hour": (96, np.int8),
+    "hour": (HOURS, np.int8),
+    "hour_of_week": (7 * HOURS, np.int16),
+    "weekday": (7, np.int8),
+    "weekend": (2, np.int8),
+    "month": (13, np.int8),
+    "day": (None, np.int16),
+}
+
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+
+
+def rounded_hours(departure_ms):
+    '''
+    Hours since 1970 after rounding to the nearest hour, ties to even like pd.Series.dt.round("60min").
+    '''
+    hours, remainder = np.divmod(departure_ms, MS_PER_HOUR)
+    half = MS_PER_HOUR // 2
+    round_up = (remainder > half) | ((remainder == half) & (hours % 2 == 1))
+    return (hours + round_up).astype(np.int64)
+
+def time_bins(departure_ms, names=tuple(BINS)):
+    '''
+    Dict of bin name -> codes of the departures, for the given bin names.
+    '''
+    departure_ms = np.asarray(departure_ms, dtype=np.int64)
+    days, hours = np.divmod(rounded_hours(departure_ms), HOURS)
+    weekdays = (days + EPOCH_WEEKDAY) % 7
+
+    codes = {}
+    for name in names:
+        if name == "quarter_hour":
+            values = departure_ms // (15 * MS_PER_MINUTE) % BINS["quarter_hour"][0]
+        elif name == "hour":
+            values = hours
+        elif name == "hour_of_week":
+            values = weekdays * HOURS + hours
+        elif name == "weekday":
+            values = weekdays
+        elif name == "weekend":
+            values = weekdays >= 5
+        elif name == "month":
+            values = (departure_ms // MS_PER_DAY).astype("datetime64[D]").astype("datetime64[M]").astype(np.int64) % 12 + 1
+        elif name == "day":
+            values = days
+        else:
+            raise ValueError(f"unknown time bin {name}")
+        codes[name] = values.astype(BINS[name][1])
+    return codes
+
+
+def add_time_bins(df, column="Departure"):
+    departure_ms = df[column].to_numpy().astype("datetime64[ms]").astype(np.int64)
+    for name, codes in time_bins(departure_ms).items():
+        df[name] = codes
+    return df
+
+
+def bin_window(start, end, size):
+    '''
+    Codes from start to end inclusive, wrapping around at size: bin_window(23, 4, 24) -> [23, 0, 1, 2, 3, 4].
+    '''
+    return [(start + i) % size for i in range((end - start) % size + 1)]
+
+def hour_window(start, end):
+    return bin_window(start, end, HOURS)
+
+def window_mask(codes, window, size):
+    lookup = np.zeros(size, dtype=bool)
+    lookup[list(window)] = True
+    return lookup[codes]
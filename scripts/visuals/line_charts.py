@@ -1,26 +1,28 @@
 import os
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
+from od_tensor import ODTensor, HOURS
+from create_net_flows import NetFlows
+
 '''
 Creates and saves the line charts for the presentation as html files.
 '''
 
 def trips_per_hour():
     cwd = os.getcwd()
-    grouped_counts_path = f"{cwd}/data/processed/grouped_counts.csv"
     save_path = f"{cwd}/presentation/trips_per_hour.html"
 
 
-    grouped_counts_df = pd.read_csv(grouped_counts_path)
+    od_tensor = ODTensor.load()
 
-    df = grouped_counts_df.groupby("time")["count"].sum().reset_index()
-    df["count"] = df["count"] / 214
-    df["time"] = pd.to_datetime(df["time"])
+    df = pd.DataFrame({"hour": np.arange(HOURS), "count": od_tensor.hourly_totals() / 214})
+    df["time"] = pd.to_datetime(df["hour"], unit="h")
 
     fig = go.Figure()
 
@@ -57,16 +59,16 @@ def trips_per_hour():
 def net_flow_groups():
     cwd = os.getcwd()
     points_gdf_path = f"{cwd}/data/processed/points_gdf.gpkg"
-    net_flow_df = f"{cwd}/data/processed/net_flow_df.csv"
     save_path = f"{cwd}/presentation/net_flow_groups.html"
 
     points_gdf = gpd.read_file(points_gdf_path)
-    net_flow_df = pd.read_csv(net_flow_df)
+    od_tensor = ODTensor.load()
 
+    net_flow_df = NetFlows.from_od_tensor(od_tensor).to_frame()
 
     net_flow_segmented = pd.merge(net_flow_df, points_gdf[["Departure station id", "group"]])
-    df = net_flow_segmented.groupby(["group", "time"])["net_flow"].mean().reset_index()
-    df["time"] = pd.to_datetime(df["time"])
+    df = net_flow_segmented.groupby(["group", "hour"])["net_flow"].mean().reset_index()
+    df["time"] = pd.to_datetime(df["hour"], unit="h")
 
     fig = make_subplots(1,2)
 
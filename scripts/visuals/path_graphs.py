@@ -4,17 +4,23 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 
-from shapely.geometry import Point, LineString, MultiLineString
+from shapely.geometry import Point, MultiLineString
 from shapely.ops import unary_union, linemerge
 from shapely import simplify
 
-import folium
 from branca.colormap import LinearColormap
 
-from .utils import save_folium_map
+from .utils import save_map, render_many
+from .tile_pyramid import export_tile_pyramid
 
-def segments(curve):
-    return list(map(LineString, zip(curve.coords[:-1], curve.coords[1:])))
+from od_tensor import ODTensor
+from time_bins import hour_window
+from graph_store import GraphStore
+from edge_incidence import EdgeIncidence
+from instrumentation import measure
+
+# transparent to white through purple over log2(count + 1)
+COLORS = [(0,0,0,0), (16*2, 1*2, 102*2, 128), (255,255,255,255)]
 
 
 class DataProcessor():
@@ -28,58 +34,73 @@ class DataProcessor():
         self.station_coords_dict = stations_df.set_index("ID")["geometry"].to_dict()
         self.stations_df = stations_df.set_index("ID")
 
-    def create_path_geometries_dict(self, journey_routes_path):
-        path_geometries = gpd.read_file(journey_routes_path)[["ids", "geometry"]].rename(columns={"ids":"path_id"})
-        path_geometries = path_geometries.drop_duplicates("path_id")
-
-        mask = path_geometries["geometry"].apply(lambda x: type(x) == LineString)
-        path_geometries = path_geometries[mask]
-        path_geometries = path_geometries.reset_index(drop=True)
-        path_geometries["geometry"] = path_geometries["geometry"].apply(lambda line: LineString([(round(point[0], 4), round(point[1], 4)) for point in line.coords]))
-
-        self.path_geometries_dict = path_geometries.set_index("path_id")["geometry"].to_dict()
-
-    def load_grouped_counts(self, grouped_counts_path):
-        data = pd.read_csv(grouped_counts_path)
-        data["geometry"] = data["ids"].map(self.path_geometries_dict)
-        data = data.dropna()
-        self.data = data.reset_index(drop=True)
-
-
-    def create_and_save_map(self, station_group, time_group, lat_center, lon_center, zoom, save_path):
-        data2 = self.data[(self.data["Departure station id"].isin(station_group)) & (self.data["time"].isin(time_group))]
-
-        data2["segments"] = data2["geometry"].apply(lambda x: segments(x))
-
-        data2 = data2.explode("segments")
-        data2["segments_wkt"] = data2["segments"].apply(lambda x: x.wkt)
-        data2 = data2.groupby("segments_wkt").agg({"count":"sum", "segments":"first"}).reset_index()
-        data2 = data2.groupby("count")["segments"].apply(list).reset_index()
-        data2["segments"] = data2["segments"].apply(lambda x: unary_union(x))
-        data2["segments"] = data2["segments"].apply(lambda x: linemerge(x) if type(x) == MultiLineString else x)
-        data2["segments"] = data2["segments"].apply(lambda line: simplify(line, tolerance=0.00007))
+    def load_edge_incidence(self, incidence_path, route_store_path, graph_path):
+        self.incidence = EdgeIncidence.load(incidence_path, route_store_path)
+        self.graph_store = GraphStore(graph_path)
+
+    def load_od_tensor(self, od_tensor_path=None):
+        self.od_tensor = ODTensor.load(od_tensor_path)
+
+    def edge_counts(self, station_group, time_group):
+        '''
+        Trips over every road edge for departures from station_group during time_group.
+        '''
+        with measure("edge_counts") as record:
+            data = self.od_tensor.pair_counts(station_group, time_group)
+
+            edge_traffic = self.incidence.edge_traffic(self.incidence.route_vector(data["pair_key"], data["count"]))
+            used = np.flatnonzero(edge_traffic)
+            record["rows_in"] = len(data)
+            record["rows_out"] = len(used)
+
+        return pd.DataFrame({"count": edge_traffic[used].astype(np.int64), "segments": self.incidence.edge_segments(self.graph_store)[used]})
+
+    def map_job(self, station_group, time_group, lat_center, lon_center, zoom, save_path, backend="static"):
+        '''
+        Keyword arguments of save_map for the paths of station_group during time_group.
+        '''
+        data2 = self.edge_counts(station_group, time_group)
+        with measure("segment_union", rows_in=len(data2)) as record:
+            data2 = data2.groupby("count")["segments"].apply(list).reset_index()
+            data2["segments"] = data2["segments"].apply(lambda x: unary_union(x))
+            data2["segments"] = data2["segments"].apply(lambda x: linemerge(x) if type(x) == MultiLineString else x)
+            data2["segments"] = data2["segments"].apply(lambda line: simplify(line, tolerance=0.00007))
+            record["rows_out"] = len(data2)
 
         gdf = gpd.GeoDataFrame(data2, geometry="segments", crs="EPSG:4326")
         gdf["count"] = np.log2(gdf["count"] + 1)
 
         custom_cmap = LinearColormap(self.colors, vmin=gdf["count"].min(), vmax=gdf["count"].max())
 
-        m = folium.Map(location=[lat_center, lon_center], zoom_start=zoom, tiles="CartoDB dark_matter",)
-        gdf.explore(m=m, column="count", cmap=custom_cmap, vmin=1, vmax=8)
+        layers = [{"gdf": gdf, "column": "count", "cmap": custom_cmap, "vmin": 1, "vmax": 8}]
 
         if len(station_group) == 1:
-            gpd.GeoDataFrame(geometry=[self.stations_df["geometry"][station_group[0]]], crs=gdf.crs).explore(m=m, color="#DCBF01", marker_kwds={"radius":4}, style_kwds={"fillOpacity":1})
+            station = gpd.GeoDataFrame(geometry=[self.stations_df["geometry"][station_group[0]]], crs=gdf.crs)
+            layers.append({"gdf": station, "color": "#DCBF01", "marker_kwds": {"radius":4}, "style_kwds": {"fillOpacity":1}})
 
-        save_folium_map(m=m, save_path=save_path)
+        return {"layers": layers, "lat_center": lat_center, "lon_center": lon_center, "zoom": zoom, "save_path": save_path, "tiles": "CartoDB dark_matter", "backend": backend}
 
+    def create_and_save_map(self, station_group, time_group, lat_center, lon_center, zoom, save_path, backend="static"):
+        save_map(**self.map_job(station_group, time_group, lat_center, lon_center, zoom, save_path, backend))
 
-def path_graphs_main():
+    def export_tiles(self, station_group, time_group, lat_center, lon_center, zoom, save_dir):
+        '''
+        Level-of-detail tile pyramid and viewer of the paths of station_group during time_group.
+        '''
+        data = self.edge_counts(station_group, time_group)
+        markers = []
+        if len(station_group) == 1:
+            station = self.stations_df.loc[station_group[0]]
+            markers.append((station.y, station.x))
+        export_tile_pyramid(data["count"].to_numpy(), data["segments"].to_numpy(), save_dir, lat_center, lon_center, zoom, self.colors, vmin=1, vmax=8, markers=markers)
+
+
+def path_graphs_main(backend="static"):
     cwd = os.getcwd()
-    journey_routes_path = f"{cwd}/data/processed/journey_routes.gpkg"
+    route_store_path = f"{cwd}/data/processed/routes"
+    incidence_path = f"{cwd}/data/processed/edge_incidence"
+    graph_path = f"{cwd}/data/processed/graph"
     stations_path = f"{cwd}/data/raw/Helsingin_ja_Espoon_kaupunkipyöräasemat_avoin_7704606743268189464.csv"
-    grouped_counts_path = f"{cwd}/data/processed/grouped_counts.csv"
-
-    colors = [(0,0,0,0), (16*2, 1*2, 102*2, 128), (255,255,255,255)]
 
     herttoniemenranta_group = [
         257,
@@ -98,28 +119,41 @@ def path_graphs_main():
     pajamäki = 216
     tapanila = 351
 
-    morning_times = ["06:00:00", "07:00:00", "08:00:00", "09:00:00", "10:00:00"]
-    evening_times = ["14:00:00", "15:00:00", "16:00:00", "17:00:00", "18:00:00"]
+    morning_times = hour_window(6, 10)
+    evening_times = hour_window(14, 18)
 
-    processor = DataProcessor(colors=colors)
+    processor = DataProcessor(colors=COLORS)
     processor.create_station_points_dict(stations_path)
-    processor.create_path_geometries_dict(journey_routes_path)
-    processor.load_grouped_counts(grouped_counts_path)
+    processor.load_edge_incidence(incidence_path, route_store_path, graph_path)
+    processor.load_od_tensor()
 
     map_lon_center = processor.stations_df["x"].mean()
     map_lat_center = processor.stations_df["y"].mean()
 
-    processor.create_and_save_map(station_group=herttoniemenranta_group, time_group=morning_times, lat_center=map_lat_center, lon_center=map_lon_center, zoom=12, save_path=f"{cwd}/presentation/herttoniemi_morning.png")
-    processor.create_and_save_map(station_group=herttoniemenranta_group, time_group=evening_times, lat_center=map_lat_center, lon_center=map_lon_center, zoom=12, save_path=f"{cwd}/presentation/herttoniemi_afternoon.png")
+    # name -> (station_group, time_group, lat_center, lon_center, zoom)
+    maps = {
+        "herttoniemi_morning": (herttoniemenranta_group, morning_times, map_lat_center, map_lon_center, 12),
+        "herttoniemi_afternoon": (herttoniemenranta_group, evening_times, map_lat_center, map_lon_center, 12),
 
-    processor.create_and_save_map(station_group=railway_station_group, time_group=morning_times, lat_center=map_lat_center, lon_center=map_lon_center-0.1, zoom=12, save_path=f"{cwd}/presentation/steissi_morning.png")
-    processor.create_and_save_map(station_group=railway_station_group, time_group=evening_times, lat_center=map_lat_center, lon_center=map_lon_center-0.1, zoom=12, save_path=f"{cwd}/presentation/steissi_afternoon.png")
+        "steissi_morning": (railway_station_group, morning_times, map_lat_center, map_lon_center-0.1, 12),
+        "steissi_afternoon": (railway_station_group, evening_times, map_lat_center, map_lon_center-0.1, 12),
+    }
 
     for station_id, station_name in zip([vuosaari, pajamäki, tapanila], ["vuosaari", "pajamäki", "tapanila"]):
         lon = processor.stations_df.loc[station_id].x
         lat = processor.stations_df.loc[station_id].y
-        processor.create_and_save_map(station_group=[station_id], time_group=morning_times, lat_center=lat-0.03, lon_center=lon-0.07, zoom=13, save_path=f"{cwd}/presentation/{station_name}.png")
-    
+        maps[station_name] = ([station_id], morning_times, lat-0.03, lon-0.07, 13)
+
+    # the tiles backend exports an interactive pyramid per map instead of rendering an image
+    if backend == "tiles":
+        for name, spec in maps.items():
+            processor.export_tiles(*spec, save_dir=f"{cwd}/presentation/tiles/{name}")
+        return
+
+    jobs = [processor.map_job(*spec, save_path=f"{cwd}/presentation/{name}.png", backend=backend) for name, spec in maps.items()]
+
+    # the folium backend drives one browser per map, only the static maps are rendered in parallel
+    render_many(jobs, processes=None if backend == "static" else 1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    path_graphs_main()
@@ -0,0 +1,224 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import shapely
+from shapely.ops import linemerge
+
+from .utils import ZOOM_0_RESOLUTION, mercator
+
+from instrumentation import measure
+
+'''
+Level-of-detail tile pyramid of the edge traffic of a path map, for interactive viewing.
+
+The edges are grouped into classes of log2(count + 1) in CLASS_STEP steps, and every class is
+unioned and line-merged once in EPSG:3857. For every zoom from MIN_ZOOM to MAX_ZOOM the classes
+below the threshold of the zoom are dropped, the rest are simplified to half a pixel at that zoom
+and cut at the exact borders of the XYZ web map tiles they cross. Leaflet draws the tiles as
+plain layers without clipping them, so overlapping tiles would draw lines twice. Each tile is
+written as <z>/<x>/<y>.geojson (EPSG:4326), index.json lists the tiles and the colour scale, and
+index.html is a Leaflet viewer that fetches only the tiles in view at the current zoom. Browsers do not fetch files from
+file:// urls, so the directory has to be served, e.g. with python -m http.server.
+'''
+
+MIN_ZOOM = 10
+MAX_ZOOM = 15
+
+# log2(count + 1) below which the edges are left out at each zoom, only busy edges when zoomed out
+MIN_LOG2_COUNT = {10: 5, 11: 4, 12: 3, 13: 2, 14: 1, 15: 0}
+
+CLASS_STEP = 0.25
+COORDINATE_DECIMALS = 6
+
+EARTH_RADIUS = 6378137
+WORLD_HALF_WIDTH = np.pi * EARTH_RADIUS
+
+
+def inverse_mercator(coords):
+    lon = np.degrees(coords[:, 0] / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(coords[:, 1] / EARTH_RADIUS)) - np.pi / 2)
+    return np.round(np.column_stack([lon, lat]), COORDINATE_DECIMALS)
+
+def pixel_size(zoom):
+    return ZOOM_0_RESOLUTION / 2**zoom
+
+def tile_bounds(zoom, x, y):
+    size = 2 * WORLD_HALF_WIDTH / 2**zoom
+    xmin = -WORLD_HALF_WIDTH + x * size
+    ymax = WORLD_HALF_WIDTH - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+def tile_range(zoom, bounds):
+    '''
+    Columns and rows of the tiles covering bounds (xmin, ymin, xmax, ymax in EPSG:3857).
+    '''
+    size = 2 * WORLD_HALF_WIDTH / 2**zoom
+    xmin, ymin, xmax, ymax = bounds
+    columns = range(int((xmin + WORLD_HALF_WIDTH) // size), int((xmax + WORLD_HALF_WIDTH) // size) + 1)
+    rows = range(int((WORLD_HALF_WIDTH - ymax) // size), int((WORLD_HALF_WIDTH - ymin) // size) + 1)
+    return columns, rows
+
+
+def count_classes(counts, segments):
+    '''
+    Merged lines (EPSG:3857) of every class of log2(count + 1), keyed by the class value.
+    '''
+    values = np.floor(np.log2(np.asarray(counts, dtype=np.float64) + 1) / CLASS_STEP) * CLASS_STEP
+    segments = shapely.transform(segments, lambda coords: np.column_stack(mercator(coords[:, 0], coords[:, 1])))
+
+    classes = {}
+    for value in np.unique(values):
+        lines = shapely.union_all(segments[values == value])
+        classes[float(value)] = linemerge(lines) if lines.geom_type == "MultiLineString" else lines
+    return classes
+
+def zoom_lines(classes, zoom):
+    '''
+    Class values and lines kept at zoom, simplified to half a pixel and split into their parts.
+    '''
+    values, parts = [], []
+    for value, lines in classes.items():
+        if value < MIN_LOG2_COUNT[zoom]:
+            continue
+        lines = shapely.get_parts(shapely.simplify(lines, pixel_size(zoom) / 2))
+        values.append(np.full(len(lines), value))
+        parts.append(lines)
+    if not parts:
+        return np.empty(0), np.empty(0, dtype=object)
+    return np.concatenate(values), np.concatenate(parts)
+
+def tile_features(values, parts, bounds):
+    clipped = shapely.clip_by_rect(parts, *bounds)
+    kept = ~shapely.is_empty(clipped)
+    features = []
+    for value, geometry in zip(values[kept], shapely.transform(clipped[kept], inverse_mercator)):
+        features.append({"type": "Feature", "properties": {"value": value}, "geometry": json.loads(shapely.to_geojson(geometry))})
+    return features
+
+def write_zoom_tiles(values, parts, zoom, save_dir):
+    '''
+    Writes the tiles of one zoom, returns their [x, y].
+    '''
+    if len(parts) == 0:
+        return []
+    tree = shapely.STRtree(parts)
+    columns, rows = tile_range(zoom, shapely.total_bounds(parts))
+
+    written = []
+    for x in columns:
+        for y in rows:
+            bounds = tile_bounds(zoom, x, y)
+            candidates = tree.query(shapely.box(*bounds))
+            if len(candidates) == 0:
+                continue
+            features = tile_features(values[candidates], parts[candidates], bounds)
+            if not features:
+                continue
+            os.makedirs(f"{save_dir}/{zoom}/{x}", exist_ok=True)
+            with open(f"{save_dir}/{zoom}/{x}/{y}.geojson", "w") as f:
+                json.dump({"type": "FeatureCollection", "features": features}, f, separators=(",", ":"))
+            written.append([x, y])
+    return written
+
+def export_tile_pyramid(counts, segments, save_dir, lat_center, lon_center, zoom, colors, vmin=1, vmax=8, markers=()):
+    '''
+    Writes the pyramid of edges with counts trips and their two-point segments (EPSG:4326) to
+    save_dir, with a viewer opening at lat_center, lon_center and zoom. Colours are rgba tuples
+    spread over vmin..vmax of log2(count + 1), markers are (lat, lon) points shown on top.
+    '''
+    shutil.rmtree(save_dir, ignore_errors=True)
+    os.makedirs(save_dir)
+
+    with measure("tile_pyramid", rows_in=len(counts), map=os.path.basename(save_dir)) as record:
+        classes = count_classes(counts, segments)
+        tiles = {}
+        for z in range(MIN_ZOOM, MAX_ZOOM + 1):
+            tiles[z] = write_zoom_tiles(*zoom_lines(classes, z), z, save_dir)
+        record["rows_out"] = sum(len(written) for written in tiles.values())
+
+    index = {
+        "min_zoom": MIN_ZOOM,
+        "max_zoom": MAX_ZOOM,
+        "center": [lat_center, lon_center],
+        "zoom": zoom,
+        "colors": [list(color) + [255] * (4 - len(color)) for color in colors],
+        "vmin": vmin,
+        "vmax": vmax,
+        "markers": [list(marker) for marker in markers],
+        "tiles": {str(z): written for z, written in tiles.items()},
+    }
+    with open(f"{save_dir}/index.json", "w") as f:
+        json.dump(index, f)
+    with open(f"{save_dir}/index.html", "w") as f:
+        f.write(VIEWER_HTML)
+    return save_dir
+
+
+VIEWER_HTML = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map { height: 100%; margin: 0; }</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+fetch("index.json").then(response => response.json()).then(index => {
+    const map = L.map("map").setView(index.center, index.zoom);
+    L.tileLayer("https://{s}.basemaps.cartocdn.com/dark_all/{z}/{x}/{y}{r}.png", {
+        attribution: "&copy; OpenStreetMap contributors &copy; CARTO", subdomains: "abcd", maxZoom: 20
+    }).addTo(map);
+
+    const available = {};
+    for (const [z, tiles] of Object.entries(index.tiles)) {
+        available[z] = new Set(tiles.map(([x, y]) => x + "/" + y));
+    }
+
+    function color(value) {
+        const t = Math.min(Math.max((value - index.vmin) / (index.vmax - index.vmin), 0), 1) * (index.colors.length - 1);
+        const i = Math.min(Math.floor(t), index.colors.length - 2), f = t - i;
+        const [a, b] = [index.colors[i], index.colors[i + 1]];
+        const c = a.map((v, k) => v + (b[k] - v) * f);
+        return {color: `rgb(${c[0]}, ${c[1]}, ${c[2]})`, opacity: c[3] / 255};
+    }
+
+    const loaded = new Map();
+    function update() {
+        const z = Math.min(Math.max(Math.round(map.getZoom()), index.min_zoom), index.max_zoom);
+        const bounds = map.getBounds();
+        const wanted = new Set();
+        const n = 2 ** z;
+        const tx = lon => Math.floor((lon + 180) / 360 * n);
+        const ty = lat => Math.floor((1 - Math.log(Math.tan(lat * Math.PI / 180) + 1 / Math.cos(lat * Math.PI / 180)) / Math.PI) / 2 * n);
+        for (let x = tx(bounds.getWest()); x <= tx(bounds.getEast()); x++) {
+            for (let y = ty(bounds.getNorth()); y <= ty(bounds.getSouth()); y++) {
+                const key = z + "/" + x + "/" + y;
+                if ((available[z] || new Set()).has(x + "/" + y)) wanted.add(key);
+            }
+        }
+        for (const [key, layer] of loaded) {
+            if (!wanted.has(key)) { map.removeLayer(layer); loaded.delete(key); }
+        }
+        for (const key of wanted) {
+            if (loaded.has(key)) continue;
+            const layer = L.layerGroup().addTo(map);
+            loaded.set(key, layer);
+            fetch(key + ".geojson").then(response => response.json()).then(data => {
+                L.geoJSON(data, {style: feature => ({weight: 3, ...color(feature.properties.value)})}).addTo(layer);
+            });
+        }
+    }
+    for (const [lat, lon] of index.markers) {
+        L.circleMarker([lat, lon], {radius: 4, color: "#DCBF01", fillOpacity: 1}).addTo(map);
+    }
+    map.on("moveend", update);
+    update();
+});
+</script>
+</body>
+</html>
+'''
@@ -1,18 +1,169 @@
 import os
-from selenium import webdriver
 import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import folium
+from branca.colormap import LinearColormap
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.colors import LinearSegmentedColormap
+
+from instrumentation import measure
+
+'''
+Saving maps as PNG files.
+
+The static backend draws the layers with matplotlib straight to a PNG in the same process:
+no basemap tiles, the tiles name only picks the background colour. Extent and sizes follow
+what the browser shows for the same center and zoom in a 1920 x 1432 window, so the images
+line up with the folium ones. Many maps can be rendered at once with render_many.
+The folium backend builds the interactive map and screenshots it with Selenium.
+
+A map is described by a center, a zoom, the tiles and a list of layers. A layer is a dict of
+the GeoDataFrame under "gdf" and the keyword arguments it would get in GeoDataFrame.explore.
+'''
+
+MAP_SIZE = (1920, 1432)
+
+# meters per pixel at zoom level 0 in Web Mercator
+ZOOM_0_RESOLUTION = 156543.03392
+
+DPI = 100
+POINTS_PER_PIXEL = 72 / DPI
+
+TILE_BACKGROUNDS = {
+    "CartoDB dark_matter": "#090909",
+    "CartoDB dark-matter": "#090909",
+    "CartoDB positron": "#fafaf8",
+}
+
+# leaflet defaults that explore does not override
+DEFAULT_WEIGHT = 3
+DEFAULT_RADIUS = 2
+DEFAULT_FILL_OPACITY = 0.5
+
 
 def save_folium_map(m, save_path):
     delay=2
-    fn='temp_map.html'
-    tmpurl='file://{path}/{mapfile}'.format(path=os.getcwd(),mapfile=fn)
+    # a file of its own, so that parallel renders do not overwrite each others maps
+    with tempfile.NamedTemporaryFile(suffix=".html", delete=False) as f:
+        fn = f.name
     m.save(fn)
 
-    browser = webdriver.Firefox()
-    browser.get(tmpurl)
-    browser.set_window_size(1920, 1432)
-    time.sleep(delay)
-    browser.save_screenshot(save_path)
-    browser.quit()
-    os.remove(fn)
\ No newline at end of file
+    from selenium import webdriver
+
+    with measure("screenshot", map=os.path.basename(save_path)):
+        browser = webdriver.Firefox()
+        browser.get(f"file://{fn}")
+        browser.set_window_size(*MAP_SIZE)
+        time.sleep(delay)
+        browser.save_screenshot(save_path)
+        browser.quit()
+    os.remove(fn)
+
+
+def map_extent(lat_center, lon_center, zoom, size=MAP_SIZE):
+    '''
+    Bounds (EPSG:3857) of a size pixel window centered at lat_center, lon_center on a web map at zoom.
+    '''
+    x, y = mercator(lon_center, lat_center)
+    resolution = ZOOM_0_RESOLUTION / 2**zoom
+    half_width, half_height = size[0] * resolution / 2, size[1] * resolution / 2
+    return x - half_width, x + half_width, y - half_height, y + half_height
+
+def mercator(lon, lat):
+    x = np.radians(lon) * 6378137
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * 6378137
+    return x, y
+
+
+def to_matplotlib_cmap(cmap):
+    if isinstance(cmap, LinearColormap):
+        return LinearSegmentedColormap.from_list("custom", cmap.colors)
+    return cmap
+
+def draw_layer(ax, gdf, column=None, cmap=None, vmin=None, vmax=None, color=None, marker_kwds=None, style_kwds=None):
+    marker_kwds = marker_kwds or {}
+    style_kwds = style_kwds or {}
+    gdf = gdf.to_crs("EPSG:3857")
+
+    weight = style_kwds.get("weight", DEFAULT_WEIGHT) * POINTS_PER_PIXEL
+    radius = marker_kwds.get("radius", DEFAULT_RADIUS)
+    fill_opacity = style_kwds.get("fillOpacity", DEFAULT_FILL_OPACITY)
+    opacity = style_kwds.get("opacity", 1)
+
+    kwargs = {"ax": ax, "linewidth": weight, "markersize": (2 * radius * POINTS_PER_PIXEL) ** 2}
+    if column is not None:
+        vmin = gdf[column].min() if vmin is None else vmin
+        vmax = gdf[column].max() if vmax is None else vmax
+        kwargs.update(column=column, cmap=to_matplotlib_cmap(cmap), vmin=vmin, vmax=vmax)
+    else:
+        kwargs.update(color=color)
+
+    geom_types = gdf.geometry.geom_type
+    polygons = geom_types.str.contains("Polygon")
+    points = geom_types.str.contains("Point")
+    lines = ~polygons & ~points
+
+    if polygons.any():
+        # fill and outline have their own opacities like in leaflet
+        gdf[polygons].plot(**kwargs, alpha=fill_opacity, edgecolor="none")
+        gdf[polygons].set_geometry(gdf[polygons].boundary).plot(**kwargs, alpha=opacity)
+    if points.any():
+        gdf[points].plot(**kwargs, alpha=fill_opacity)
+    if lines.any():
+        gdf[lines].plot(**kwargs, alpha=opacity)
+
+def render_static_map(layers, lat_center, lon_center, zoom, save_path, tiles="CartoDB positron", size=MAP_SIZE):
+    fig = plt.figure(figsize=(size[0] / DPI, size[1] / DPI), dpi=DPI)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    fig.patch.set_facecolor(TILE_BACKGROUNDS.get(tiles, "#ffffff"))
+
+    for layer in layers:
+        layer = dict(layer)
+        draw_layer(ax, layer.pop("gdf"), **layer)
+
+    xmin, xmax, ymin, ymax = map_extent(lat_center, lon_center, zoom, size)
+    ax.set_xlim(xmin, xmax)
+    ax.set_ylim(ymin, ymax)
+
+    fig.savefig(save_path, dpi=DPI, facecolor=fig.get_facecolor())
+    plt.close(fig)
+    return save_path
+
+def render_folium_map(layers, lat_center, lon_center, zoom, save_path, tiles="CartoDB positron"):
+    m = folium.Map(location=[lat_center, lon_center], zoom_start=zoom, tiles=tiles)
+    for layer in layers:
+        layer = dict(layer)
+        layer.pop("gdf").explore(m=m, **layer)
+
+    save_folium_map(m=m, save_path=save_path)
+    return save_path
+
+def save_map(layers, lat_center, lon_center, zoom, save_path, tiles="CartoDB positron", backend="static"):
+    if backend not in ("static", "folium"):
+        raise ValueError(f"Unknown map backend {backend}")
+
+    with measure("render_map", rows_in=sum(len(layer["gdf"]) for layer in layers), backend=backend, map=os.path.basename(save_path)):
+        if backend == "static":
+            return render_static_map(layers, lat_center, lon_center, zoom, save_path, tiles)
+        return render_folium_map(layers, lat_center, lon_center, zoom, save_path, tiles)
+
+def _save_map_job(job):
+    return save_map(**job)
+
+def render_many(jobs, processes=None):
+    '''
+    Renders a list of save_map keyword argument dicts in a process pool.
+    '''
+    processes = processes or max(1, min(len(jobs), os.cpu_count() - 2))
+    with measure("render_many", rows_in=len(jobs), processes=processes):
+        if processes == 1:
+            return [_save_map_job(job) for job in jobs]
+        with ProcessPoolExecutor(processes) as executor:
+            return list(executor.map(_save_map_job, jobs))